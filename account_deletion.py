@@ -0,0 +1,210 @@
+import json
+import logging
+import sys
+import threading
+from datetime import datetime, timedelta
+from time import sleep
+from uuid import uuid4
+
+from sqlalchemy import and_, func, or_
+
+import crud
+import files
+import models
+from database import SessionLocal
+
+logger = logging.getLogger("marblesound.account_deletion")
+
+BATCH_SIZE = 500
+BATCH_PAUSE = 0.05
+
+STALE_SECONDS = 300
+COUNTERS = ("audios", "audiosgenres", "playlistaudio", "favorites", "playlists")
+
+# Задача хранится в таблице: статус виден всем воркерам, а прерванная задача продолжается при старте
+class DeletionJob:
+    def __init__(self, row: models.UserDeletionJob):
+        self.row = row
+        self.user_id = row.user_id
+        self.deleted = json.loads(row.deleted)
+
+    def commit(self, db):
+        self.row.deleted = json.dumps(self.deleted)
+        self.row.heartbeat_at = datetime.now()
+        db.commit()
+
+def to_dict(row: models.UserDeletionJob) -> dict:
+    return {
+        "job_id": row.id,
+        "user_id": row.user_id,
+        "status": row.status,
+        "error": row.error,
+        "started_at": row.started_at,
+        "finished_at": row.finished_at,
+        "deleted": json.loads(row.deleted)
+    }
+
+def _create(db, user_id: int) -> models.UserDeletionJob:
+    row = db.query(models.UserDeletionJob).filter(
+        models.UserDeletionJob.user_id == user_id,
+        models.UserDeletionJob.status != "done"
+    ).first()
+    if row is None:
+        row = models.UserDeletionJob(
+            id=uuid4().hex,
+            user_id=user_id,
+            status="queued",
+            deleted=json.dumps(dict.fromkeys(COUNTERS, 0)),
+            created_at=datetime.now()
+        )
+        db.add(row)
+    db.commit()
+    return row
+
+def start(db, user_id: int) -> dict:
+    row = _create(db, user_id)
+    _spawn(row.id)
+    return to_dict(row)
+
+def get_job(db, job_id: str):
+    row = db.query(models.UserDeletionJob).filter(models.UserDeletionJob.id == job_id).first()
+    return to_dict(row) if row else None
+
+def resume():
+    db = SessionLocal()
+    try:
+        job_ids = [row[0] for row in db.query(models.UserDeletionJob.id).filter(
+            models.UserDeletionJob.status != "done"
+        )]
+    finally:
+        db.close()
+    for job_id in job_ids:
+        _spawn(job_id)
+
+def _spawn(job_id: str):
+    threading.Thread(target=_run, args=(job_id,), name=f"delete-user-{job_id}", daemon=True).start()
+
+def _claim(db, job_id: str) -> bool:
+    # Забирает задачу атомарно: новую, упавшую или брошенную воркером без сердцебиения
+    now = datetime.now()
+    claimed = db.query(models.UserDeletionJob).filter(
+        models.UserDeletionJob.id == job_id,
+        or_(
+            models.UserDeletionJob.status.in_(("queued", "failed")),
+            and_(
+                models.UserDeletionJob.status == "running",
+                models.UserDeletionJob.heartbeat_at < now - timedelta(seconds=STALE_SECONDS)
+            )
+        )
+    ).update({
+        "status": "running",
+        "error": None,
+        "heartbeat_at": now,
+        "started_at": func.coalesce(models.UserDeletionJob.started_at, now)
+    }, synchronize_session=False)
+    db.commit()
+    return claimed == 1
+
+# =====================
+# Batched deletion
+# =====================
+
+def _delete_batches(db, job: DeletionJob, model, counter: str, *filters):
+    while True:
+        ids = [row[0] for row in db.query(model.id).filter(*filters).limit(BATCH_SIZE)]
+        if not ids:
+            return
+        db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        job.deleted[counter] += len(ids)
+        job.commit(db)
+        sleep(BATCH_PAUSE)
+
+def _delete_audios(db, job: DeletionJob):
+    while True:
+        rows = db.query(models.Audio.id, models.Audio.file, models.Audio.cover).filter(
+            models.Audio.author_id == job.user_id
+        ).order_by(models.Audio.id).limit(BATCH_SIZE).all()
+        if not rows:
+            return
+        ids = [row.id for row in rows]
+
+        _delete_batches(db, job, models.AudioGenre, "audiosgenres", models.AudioGenre.audio_id.in_(ids))
+        _delete_batches(db, job, models.PlaylistAudio, "playlistaudio", models.PlaylistAudio.audio_id.in_(ids))
+        _delete_batches(db, job, models.Favorite, "favorites", models.Favorite.audio_id.in_(ids))
+
+        for row in rows:
+            files.delete_after_commit(db, row.file)
+            files.delete_after_commit(db, row.cover)
+            crud.record_change(db, "audio", row.id, "delete")
+        db.query(models.Audio).filter(models.Audio.id.in_(ids)).delete(synchronize_session=False)
+        job.deleted["audios"] += len(ids)
+        job.commit(db)
+        sleep(BATCH_PAUSE)
+
+def _delete_playlists(db, job: DeletionJob):
+    while True:
+        rows = db.query(models.Playlist.id, models.Playlist.cover).filter(
+            models.Playlist.author_id == job.user_id
+        ).order_by(models.Playlist.id).limit(BATCH_SIZE).all()
+        if not rows:
+            return
+        ids = [row.id for row in rows]
+
+        _delete_batches(db, job, models.PlaylistAudio, "playlistaudio", models.PlaylistAudio.playlist_id.in_(ids))
+        _delete_batches(db, job, models.Favorite, "favorites", models.Favorite.playlist_id.in_(ids))
+
+        for row in rows:
+            files.delete_after_commit(db, row.cover)
+        db.query(models.Playlist).filter(models.Playlist.id.in_(ids)).delete(synchronize_session=False)
+        job.deleted["playlists"] += len(ids)
+        job.commit(db)
+        sleep(BATCH_PAUSE)
+
+def _delete_user(db, job: DeletionJob):
+    user = db.query(models.User).filter(models.User.id == job.user_id).first()
+    if user is None:
+        return
+    files.delete_after_commit(db, user.avatar)
+    db.query(models.UserHashedData).filter(models.UserHashedData.user_id == job.user_id).delete()
+    crud.record_change(db, "user", job.user_id, "delete")
+    db.delete(user)
+    job.commit(db)
+
+def _run(job_id: str):
+    db = SessionLocal()
+    try:
+        if not _claim(db, job_id):
+            return
+        job = DeletionJob(db.query(models.UserDeletionJob).filter(models.UserDeletionJob.id == job_id).one())
+        try:
+            _delete_audios(db, job)
+            _delete_playlists(db, job)
+            _delete_batches(db, job, models.Favorite, "favorites", models.Favorite.user_id == job.user_id)
+            _delete_user(db, job)
+            job.row.status = "done"
+        except Exception as e:
+            db.rollback()
+            job.deleted = json.loads(job.row.deleted)
+            job.row.status = "failed"
+            job.row.error = str(e)
+            logger.exception("Deleting user %s failed", job.user_id)
+        job.row.finished_at = datetime.now()
+        job.commit(db)
+    finally:
+        files.discard_pending(db)
+        db.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    session = SessionLocal()
+    try:
+        job_id = _create(session, int(sys.argv[1])).id
+    finally:
+        session.close()
+    _run(job_id)
+    files.shutdown()
+    session = SessionLocal()
+    try:
+        print(get_job(session, job_id))
+    finally:
+        session.close()
@@ -0,0 +1,102 @@
+import logging
+import os
+import threading
+from datetime import date
+
+from sqlalchemy.dialects.mysql import insert
+
+import models
+from database import SessionLocal
+
+logger = logging.getLogger("marblesound.analytics")
+
+EVENT_COLUMNS = {
+    "play": "plays",
+    "download": "downloads",
+    "favorite": "favorites_added",
+    "unfavorite": "favorites_removed"
+}
+FLUSH_SIZE = int(os.getenv("MARBLESOUND_ANALYTICS_FLUSH_SIZE", "1000"))
+FLUSH_SECONDS = float(os.getenv("MARBLESOUND_ANALYTICS_FLUSH_SECONDS", "10"))
+MAX_BUFFERED_ROWS = 100000
+
+_lock = threading.Lock()
+_buffer = {}
+_pending = 0
+_flush_requested = threading.Event()
+_stop = threading.Event()
+_worker = None
+
+def record(kind: str, audio_id: int, count: int = 1):
+    global _pending
+    column = EVENT_COLUMNS[kind]
+    key = (audio_id, date.today())
+    with _lock:
+        counters = _buffer.get(key)
+        if counters is None:
+            if len(_buffer) >= MAX_BUFFERED_ROWS:
+                return
+            counters = _buffer[key] = dict.fromkeys(EVENT_COLUMNS.values(), 0)
+        counters[column] += count
+        _pending += count
+        if _pending >= FLUSH_SIZE:
+            _flush_requested.set()
+
+def flush():
+    global _buffer, _pending
+    with _lock:
+        batch, _buffer, _pending = _buffer, {}, 0
+    if not batch:
+        return 0
+
+    rows = [{"audio_id": audio_id, "day": day, **counters} for (audio_id, day), counters in batch.items()]
+    statement = insert(models.AudioDailyStats)
+    statement = statement.on_duplicate_key_update({
+        column: getattr(models.AudioDailyStats, column) + getattr(statement.inserted, column)
+        for column in EVENT_COLUMNS.values()
+    })
+
+    db = SessionLocal()
+    try:
+        db.execute(statement, rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("Failed to flush %d analytics rows, keeping them buffered", len(rows))
+        _requeue(batch)
+        return 0
+    finally:
+        db.close()
+    return len(rows)
+
+def _requeue(batch: dict):
+    global _pending
+    with _lock:
+        for key, counters in batch.items():
+            current = _buffer.get(key)
+            if current is None:
+                if len(_buffer) >= MAX_BUFFERED_ROWS:
+                    continue
+                current = _buffer[key] = dict.fromkeys(EVENT_COLUMNS.values(), 0)
+            for column, value in counters.items():
+                current[column] += value
+                _pending += value
+
+def _flush_loop():
+    while not _stop.is_set():
+        _flush_requested.wait(FLUSH_SECONDS)
+        _flush_requested.clear()
+        flush()
+
+def start():
+    global _worker
+    _stop.clear()
+    _worker = threading.Thread(target=_flush_loop, name="analytics-flush", daemon=True)
+    _worker.start()
+
+def shutdown():
+    _stop.set()
+    _flush_requested.set()
+    if _worker is not None:
+        _worker.join(timeout=30)
+    flush()
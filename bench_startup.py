@@ -0,0 +1,47 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import asyncio, json, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+app = main.create_app()
+t2 = time.perf_counter()
+result = {"import": t1 - t0, "create_app": t2 - t1}
+if %(lifespan)r:
+    async def run():
+        async with app.router.lifespan_context(app):
+            result["startup"] = time.perf_counter() - t2
+    asyncio.run(run())
+print(json.dumps(result))
+"""
+
+def measure(runs: int, lifespan: bool) -> dict:
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE % {"lifespan": lifespan}],
+            check=True, capture_output=True, text=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        phase: {
+            "median_ms": round(statistics.median(s[phase] for s in samples) * 1000, 1),
+            "max_ms": round(max(s[phase] for s in samples) * 1000, 1)
+        }
+        for phase in samples[0]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure MarbleSound worker cold start.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--lifespan", action="store_true", help="also run startup hooks (needs the database)")
+    args = parser.parse_args()
+    print(json.dumps(measure(args.runs, args.lifespan), indent=2))
+
+if __name__ == "__main__":
+    main()
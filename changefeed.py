@@ -0,0 +1,36 @@
+import asyncio
+import json
+
+from starlette.concurrency import run_in_threadpool
+
+import crud
+from database import SessionLocal
+
+POLL_SECONDS = 1.0
+HEARTBEAT_SECONDS = 15.0
+
+def _read_batch(since: int, limit: int):
+    db = SessionLocal()
+    try:
+        return crud.get_changes(db, since, limit)
+    finally:
+        db.close()
+
+async def stream_changes(request, since: int, limit: int = 500):
+    idle = 0.0
+    while not await request.is_disconnected():
+        batch = await run_in_threadpool(_read_batch, since, limit)
+        for change in batch["changes"]:
+            yield f"id: {change['cursor']}\nevent: change\ndata: {json.dumps(change)}\n\n"
+        if batch["cursor"] != since:
+            since = batch["cursor"]
+            yield f"id: {since}\nevent: cursor\ndata: {since}\n\n"
+            idle = 0.0
+        if batch["has_more"]:
+            continue
+
+        await asyncio.sleep(POLL_SECONDS)
+        idle += POLL_SECONDS
+        if idle >= HEARTBEAT_SECONDS:
+            idle = 0.0
+            yield ": heartbeat\n\n"
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import os
+import threading
+from time import monotonic
+
+from starlette.concurrency import run_in_threadpool
+
+from cache import LRUCache
+from database import SessionLocal
+
+logger = logging.getLogger("marblesound.coalesce")
+
+ENDPOINTS = {
+    name.strip()
+    for name in os.getenv("MARBLESOUND_COALESCE", "audios_popular,audios_search").split(",")
+    if name.strip()
+}
+FRESH_SECONDS = float(os.getenv("MARBLESOUND_COALESCE_TTL", "0"))
+STALE_SECONDS = float(os.getenv("MARBLESOUND_COALESCE_STALE", "0"))
+
+# Ожидающие запросы живут в event loop, поэтому не занимают потоки пула
+_inflight = {}
+_results = LRUCache(max_entries=1024)
+_refreshing = set()
+_refresh_lock = threading.Lock()
+
+async def run(name: str, key: tuple, compute, db):
+    if name not in ENDPOINTS:
+        return await run_in_threadpool(compute, db)
+
+    full_key = (name, key)
+    if FRESH_SECONDS or STALE_SECONDS:
+        entry = _results.get(full_key)
+        if entry is not None:
+            value, computed_at = entry
+            age = monotonic() - computed_at
+            if age < FRESH_SECONDS:
+                return value
+            if age < FRESH_SECONDS + STALE_SECONDS:
+                _refresh(full_key, compute)
+                return value
+
+    return await _single_flight(full_key, compute, db)
+
+async def _single_flight(full_key, compute, db):
+    future = _inflight.get(full_key)
+    if future is not None:
+        return await asyncio.shield(future)
+
+    future = _inflight[full_key] = asyncio.get_running_loop().create_future()
+    # Без ожидающих ошибка лидера не должна всплыть как "exception was never retrieved"
+    future.add_done_callback(lambda done: done.cancelled() or done.exception())
+    try:
+        result = await run_in_threadpool(compute, db)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        if FRESH_SECONDS or STALE_SECONDS:
+            _results.set(full_key, (result, monotonic()))
+        future.set_result(result)
+        return result
+    finally:
+        _inflight.pop(full_key, None)
+
+def _refresh(full_key, compute):
+    with _refresh_lock:
+        if full_key in _refreshing:
+            return
+        _refreshing.add(full_key)
+
+    def worker():
+        db = SessionLocal()
+        try:
+            _results.set(full_key, (compute(db), monotonic()))
+        except Exception:
+            logger.exception("Background refresh of %s failed", full_key[0])
+        finally:
+            db.close()
+            with _refresh_lock:
+                _refreshing.discard(full_key)
+
+    threading.Thread(target=worker, name=f"coalesce-{full_key[0]}", daemon=True).start()
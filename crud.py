@@ -1,16 +1,24 @@
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import or_, and_, func, exists
-from datetime import datetime
+from sqlalchemy import or_, and_, func, exists, insert
+from datetime import datetime, timedelta
 from hashing import Hasher
 from uuid import uuid4
 import models
 from enum import Enum
+from hashlib import blake2b
 from fastapi import UploadFile, HTTPException
-from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
 from typing import List, Union
 from pathlib import Path
-from pydub import AudioSegment
-from pydub.exceptions import CouldntDecodeError
+from metrics import timed
+from storage import storage
+import files
+import recommend
+import harmony
+from ordering import PLAYLIST_ORDER_GAP, PLAYLIST_ORDER_MAX, spread, rebalance_gap
+import analytics
+from cache import LRUCache
+import projection
 
 class SearchBy(str, Enum):
     id = "ID"
@@ -29,7 +37,7 @@ EXTENSION_GROUPS = {
 # Function
 # =====================
 
-def save_file(path: str, file: UploadFile) -> str:
+def save_file(path: str, file: UploadFile, db: Session = None) -> str:
     parts = path.strip("./").split("/")
     if len(parts) < 3:
         raise HTTPException(400, "Invalid path format")
@@ -52,33 +60,51 @@ def save_file(path: str, file: UploadFile) -> str:
     if file_ext not in allowed_extensions:
         raise HTTPException(400, f"Unsupported file type {file_ext} - {file.filename}")
 
-    base_dir.mkdir(parents=True, exist_ok=True)
-    
-    filename = f"{uuid4().hex}{file_ext}"
-    filepath = base_dir / filename
+    key = f"{base_dir.as_posix()}/{uuid4().hex}{file_ext}"
 
     try:
-        with filepath.open("wb") as buffer:
-            buffer.write(file.file.read())
+        with timed("disk"):
+            storage.save(key, file.file)
     except Exception as e:
         raise HTTPException(500, f"Failed to save file: {str(e)}")
 
-    return str(filepath).replace("\\", "/")
+    if db is not None:
+        files.track_upload(db, key)
+    return key
 
-def get_file(filepath: str) -> FileResponse:
-    absolute_path = Path.cwd() / filepath
-    if not absolute_path.exists():
+def get_file(filepath: str):
+    if not filepath or not storage.exists(filepath):
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(
-        path=absolute_path,
-        filename=absolute_path.name,
-        media_type='multipart/form-data'
-    )
+    return storage.response(filepath)
+
+def get_audio_duration(file: UploadFile):
+    from pydub import AudioSegment
+    from pydub.exceptions import CouldntDecodeError
+
+    try:
+        with timed("pydub"):
+            audio = AudioSegment.from_file(file.file, format=Path(file.filename).suffix.lower().lstrip("."))
+        return len(audio) / 1000
+    except CouldntDecodeError:
+        return None
+    except Exception:
+        return None
+    finally:
+        file.file.seek(0)
+
 # =====================
 # User control
 # =====================
 
-def create_user(username: str, password: str, db: Session):
+# Вход и регистрация ждут bcrypt в event loop, не занимая потоков пула; запросы к БД идут через threadpool
+async def create_user(username: str, password: str, db: Session):
+    session = str(uuid4())
+    hashed_password = await Hasher.get_hash_async(password)
+    hashed_session = await Hasher.get_hash_async(session)
+    user_id = await run_in_threadpool(_insert_user, db, username, hashed_password, hashed_session)
+    return {"id": user_id, "session": session}
+
+def _insert_user(db: Session, username: str, hashed_password: str, hashed_session: str):
     db_user = models.User(
         username=username,
         date_of_reg=datetime.now()
@@ -86,15 +112,14 @@ def create_user(username: str, password: str, db: Session):
 
     db.add(db_user)
     db.flush()
-    session = str(uuid4())
     db_user_password = models.UserHashedData(
         user_id=db_user.id,
-        hashed_password=Hasher.get_hash(password),
-        hashed_session=Hasher.get_hash(session)
+        hashed_password=hashed_password,
+        hashed_session=hashed_session
     )
     db.add(db_user_password)
     db.commit()
-    return {"id": db_user.id, "session": str(session)}
+    return db_user.id
 
 def get_user(db: Session, search_by: SearchBy = SearchBy.id, username: str = None, id: int = None):
     if search_by == SearchBy.id and id is not None:
@@ -119,19 +144,33 @@ def user_logout(db: Session, id:str, session:str):
     db.refresh(user_data)
     return "logout"
 
-def user_login(db: Session, username:str, password: str):
+async def user_login(db: Session, username:str, password: str):
+    user_id, hashed_password = await run_in_threadpool(_get_login_record, db, username)
+    if not await Hasher.verify_hash_async(password, hashed_password):
+        raise HTTPException(403)
+
+    session = str(uuid4())
+    hashed_session = await Hasher.get_hash_async(session)
+    await run_in_threadpool(_store_session, db, user_id, hashed_session)
+    return {"id": user_id, "session": session}
+
+def _get_login_record(db: Session, username: str):
     user = get_user(db, SearchBy.username, username)
     if not user:
         raise HTTPException(404)
+    if db.query(exists().where(and_(
+        models.UserDeletionJob.user_id == user.id,
+        models.UserDeletionJob.status != "done"
+    ))).scalar():
+        raise HTTPException(403, "Account is being deleted")
     user_data = db.query(models.UserHashedData).filter(models.UserHashedData.user_id == user.id).first()
-    if not Hasher.verify_hash(password, user_data.hashed_password):
-        raise HTTPException(403)
-    
-    session = str(uuid4())
-    user_data.hashed_session = str(Hasher.get_hash(session))
+    return user.id, user_data.hashed_password
+
+def _store_session(db: Session, user_id: int, hashed_session: str):
+    db.query(models.UserHashedData).filter(models.UserHashedData.user_id == user_id).update(
+        {"hashed_session": hashed_session}, synchronize_session=False
+    )
     db.commit()
-    db.refresh(user_data)
-    return {"id": user.id, "session": session}
 
 def get_user_hash(db: Session, session: str, id: int):
     user_data = db.query(models.UserHashedData).filter(models.UserHashedData.user_id == id).first()
@@ -148,30 +187,32 @@ def update_user_data(db: Session, id: int, username: str = None, description: st
     if description is not None:
         user.description = description
     
+    record_change(db, "user", id)
     db.commit()
     db.refresh(user)
     return get_user(db, SearchBy.id, id=id)
 
 def update_user_avatar(db: Session, id: int, avatar: UploadFile):
     user = get_user(db, id=id)
-    file = save_file("./uploads/avatar", avatar)
+    file = save_file("./uploads/avatar", avatar, db)
+    files.delete_after_commit(db, user.avatar)
     user.avatar = file
+    record_change(db, "user", id)
     db.commit()
     db.refresh(user)
     return get_user(db, id=id)
 
-def get_user_avatar(db: Session, id: int) -> FileResponse:
+def get_user_avatar(db: Session, id: int):
     return get_file(get_user(db, id=id).avatar)
 
 def delete_user(db: Session, id: int, session: str):
     if not check_user_session(db, id, session):
         raise HTTPException(401)
-    db_user = get_user(db, SearchBy.id, id=id)
-    db_user_data = get_user_hash(db, session=session, id=id)
-    db.delete(db_user_data)
-    db.delete(db_user)
-    db.commit()
-    return 
+    db_user_data = db.query(models.UserHashedData).filter(models.UserHashedData.user_id == id).first()
+    # Сессия отзывается сразу, а сами данные удаляются фоновой задачей партиями;
+    # коммит выполняется вместе с созданием задачи (account_deletion.start)
+    db_user_data.hashed_session = None
+    _favorites_cache.pop(id)
 
 def get_user_favorites(db: Session, user_id: int):
     return db.query(models.Favorite).filter(
@@ -187,24 +228,71 @@ def remove_from_favorites(
     audio_id: int = None,
     playlist_id: int = None
 ):
+    if audio_id is None and playlist_id is None:
+        raise HTTPException(400, "Must provide either audio or playlist ID")
+    
     filters = [models.Favorite.user_id == user_id]
-    if audio_id:
+    if audio_id is not None:
         filters.append(models.Favorite.audio_id == audio_id)
-    if playlist_id:
+    if playlist_id is not None:
         filters.append(models.Favorite.playlist_id == playlist_id)
     
-    favorite = db.query(models.Favorite).filter(and_(*filters)).first()
-    if not favorite:
+    removed = db.query(models.Favorite).filter(and_(*filters)).delete(synchronize_session=False)
+    if not removed:
         raise HTTPException(404, "Favorite not found")
     
-    db.delete(favorite)
     db.commit()
+    
+    if audio_id is not None:
+        analytics.record("unfavorite", audio_id)
+    _favorites_cache.pop(user_id)
     return {"status": "removed from favorites"}
 
-def get_user_audios(db: Session, user_id: int):
-    return db.query(models.Audio).filter(
-        models.Audio.author_id == user_id
-    ).options(
+# =====================
+# Favorites membership
+# =====================
+
+_favorites_cache = LRUCache(max_entries=10000, ttl=300)
+
+def _favorites_stamp(db: Session, user_id: int) -> tuple:
+    # Дешёвая проверка по индексу (user_id, audio_id): запись в любом воркере меняет count или max(id)
+    return tuple(db.query(func.count(models.Favorite.id), func.max(models.Favorite.id)).filter(
+        models.Favorite.user_id == user_id
+    ).one())
+
+def get_favorite_ids(db: Session, user_id: int) -> dict:
+    stamp = _favorites_stamp(db, user_id)
+    entry = _favorites_cache.get(user_id)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    audios, playlists = set(), set()
+    for audio_id, playlist_id in db.query(
+        models.Favorite.audio_id, models.Favorite.playlist_id
+    ).filter(models.Favorite.user_id == user_id):
+        if audio_id is not None:
+            audios.add(audio_id)
+        if playlist_id is not None:
+            playlists.add(playlist_id)
+    # Неизменяемые множества: кэш читают параллельные запросы, поэтому при изменении запись заменяется целиком
+    favorite_ids = {"audios": frozenset(audios), "playlists": frozenset(playlists)}
+    _favorites_cache.set(user_id, (stamp, favorite_ids))
+    return favorite_ids
+
+def annotate_favorites(db: Session, user_id: int, items: list) -> list:
+    if user_id is None:
+        return items
+    favorite_audios = get_favorite_ids(db, user_id)["audios"]
+    return [
+        {**item, "is_favorited": item["audio"]["id"] in favorite_audios}
+        for item in items
+    ]
+
+def get_user_audios(db: Session, user_id: int, fields: tuple = None):
+    query = db.query(models.Audio).filter(models.Audio.author_id == user_id)
+    if fields is not None:
+        return [projection.audio_dict(audio, fields) for audio in query.options(*projection.audio_options(fields))]
+    return query.options(
         joinedload(models.Audio.genres),
         joinedload(models.Audio.instrument)
     ).all()
@@ -220,8 +308,33 @@ def get_user_playlists(db: Session, user_id: int):
 # Audio control
 # =====================
 
+# =====================
+# Reference caches
+# =====================
+
+# Кэш локален для процесса: TTL ограничивает, сколько другие воркеры не видят новые жанры/тональности/инструменты
+REFERENCE_CACHE_TTL = 60
+
+_reference_cache = LRUCache(max_entries=16, ttl=REFERENCE_CACHE_TTL)
+
+def _reference_rows(db: Session, model) -> list:
+    rows = _reference_cache.get(model.__tablename__)
+    if rows is None:
+        rows = [{"id": row.id, "name": row.name} for row in db.query(model.id, model.name).order_by(model.id)]
+        _reference_cache.set(model.__tablename__, rows)
+    return rows
+
+def invalidate_reference_cache(model):
+    _reference_cache.pop(model.__tablename__, None)
+
+def warm_reference_caches(db: Session):
+    for model in (models.Genre, models.Key, models.Instrument):
+        invalidate_reference_cache(model)
+        _reference_rows(db, model)
+
 def get_genre(db: Session, id: int = None, name: str = None):
-    db_genre = db.query(models.Genre).all()
+    if id is None and name is None:
+        return _reference_rows(db, models.Genre)
     if id is not None:
         db_genre = db.query(models.Genre).filter(models.Genre.id == id).first()
     if name is not None:
@@ -229,16 +342,17 @@ def get_genre(db: Session, id: int = None, name: str = None):
     return db_genre
 
 def get_all_keys(db: Session):
-    return db.query(models.Key).all()
+    return _reference_rows(db, models.Key)
 
 def get_all_instruments(db: Session):
-    return db.query(models.Instrument).all()
+    return _reference_rows(db, models.Instrument)
 
 def create_audio(db: Session, user_id: int, file: UploadFile, cover: UploadFile, title: str, 
                  is_loop: bool, key: str, bpm: int, genres: List[str], instrument: str):
     db_user = get_user(db, SearchBy.id, id=user_id)
-    audio_file = save_file("./uploads/audio/file", file)
-    audio_cover = save_file("./uploads/audio/cover", cover) if cover is not None else None  
+    duration = get_audio_duration(file)
+    audio_file = save_file("./uploads/audio/file", file, db)
+    audio_cover = save_file("./uploads/audio/cover", cover, db) if cover is not None else None
 
     db_instrument = db.query(models.Instrument).filter(
         func.lower(models.Instrument.name) == func.lower(instrument)
@@ -246,25 +360,7 @@ def create_audio(db: Session, user_id: int, file: UploadFile, cover: UploadFile,
     if not db_instrument:
         raise HTTPException(404)
 
-    if key:
-        db_key = db.query(models.Key).filter(
-            func.lower(models.Key.name) == func.lower(key)
-        ).first()
-        
-        if not db_key:
-            db_key = models.Key(name=key.strip().upper())
-            db.add(db_key)
-            db.flush()
-
-    try:
-        audio = AudioSegment.from_file(audio_file)
-        duration = len(audio) / 1000 
-        
-    except CouldntDecodeError:
-        duration = None
-    except Exception as e:
-        duration = None
-
+    db_key = _get_or_create_key(db, key) if key else None
 
     db_audio = models.Audio(
         title=title,
@@ -290,9 +386,31 @@ def create_audio(db: Session, user_id: int, file: UploadFile, cover: UploadFile,
                 raise HTTPException(404, detail=genres) 
             db.add(models.AudioGenre(audio_id=db_audio.id, genre_id=db_genre.id))
 
+    record_change(db, "audio", db_audio.id)
     db.commit()
+    invalidate_reference_cache(models.Key)
     return {"id": db_audio.id}
 
+def _get_or_create_key(db: Session, key: str):
+    parsed = harmony.parse_key(key)
+    if parsed is not None:
+        for row in _reference_rows(db, models.Key):
+            if harmony.parse_key(row["name"]) == parsed:
+                return db.query(models.Key).filter(models.Key.id == row["id"]).first()
+        name = harmony.canonical_name(parsed)
+    else:
+        name = key.strip().upper()
+
+    db_key = db.query(models.Key).filter(
+        func.lower(models.Key.name) == func.lower(name)
+    ).first()
+    if not db_key:
+        db_key = models.Key(name=name)
+        db.add(db_key)
+        db.flush()
+        record_change(db, "key", db_key.id)
+    return db_key
+
 def update_audio(
     db: Session,
     audio_id: int,
@@ -317,14 +435,7 @@ def update_audio(
     if is_loop is not None: db_audio.is_loop = is_loop
     
     if key:
-        db_key = db.query(models.Key).filter(
-            func.lower(models.Key.name) == func.lower(key.strip())
-        ).first()
-        if not db_key:
-            db_key = models.Key(name=key.strip().upper())
-            db.add(db_key)
-            db.flush()
-        db_audio.key_id = db_key.id
+        db_audio.key_id = _get_or_create_key(db, key).id
     
     if instrument:
         db_instrument = db.query(models.Instrument).filter(
@@ -349,7 +460,9 @@ def update_audio(
                 genre_id=db_genre.id
             ))
     
+    record_change(db, "audio", audio_id)
     db.commit()
+    invalidate_reference_cache(models.Key)
     return db_audio
 
 def get_audio(db: Session, id: int = None):
@@ -358,29 +471,99 @@ def get_audio(db: Session, id: int = None):
         raise HTTPException(status_code=404, detail="Audio not found")
     return audio
 
+AUDIO_BATCH_LIMIT = 100
+
+def get_audios_batch(db: Session, ids: List[int]):
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise HTTPException(400, "No audio IDs given")
+    if len(ids) > AUDIO_BATCH_LIMIT:
+        raise HTTPException(400, f"At most {AUDIO_BATCH_LIMIT} audios per request")
+
+    audios = {
+        audio.id: audio
+        for audio in db.query(models.Audio).options(
+            joinedload(models.Audio.genres),
+            joinedload(models.Audio.instrument),
+            joinedload(models.Audio.key),
+            joinedload(models.Audio.author)
+        ).filter(models.Audio.id.in_(ids))
+    }
+    counts_dict = get_favorites_counts(db, list(audios)) if audios else {}
+
+    return {
+        "items": [
+            {"audio": audios[audio_id].to_dict(), "favorites_count": counts_dict.get(audio_id, 0)}
+            for audio_id in ids if audio_id in audios
+        ],
+        "missing": [audio_id for audio_id in ids if audio_id not in audios]
+    }
+
+DOWNLOAD_LIMIT = 1000
+
+def get_download_audios(db: Session, ids: List[int]) -> list:
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise HTTPException(400, "No audio IDs given")
+    if len(ids) > DOWNLOAD_LIMIT:
+        raise HTTPException(400, f"At most {DOWNLOAD_LIMIT} audios per download")
+
+    audios = {
+        audio.id: audio.to_dict()
+        for audio in db.query(models.Audio).options(
+            joinedload(models.Audio.genres),
+            joinedload(models.Audio.instrument),
+            joinedload(models.Audio.key),
+            joinedload(models.Audio.author)
+        ).filter(models.Audio.id.in_(ids))
+    }
+    missing = [audio_id for audio_id in ids if audio_id not in audios]
+    if missing:
+        raise HTTPException(404, f"Audio not found: {missing}")
+    return [audios[audio_id] for audio_id in ids]
+
+def get_playlist_download_audios(db: Session, playlist_id: int) -> list:
+    if not db.query(exists().where(models.Playlist.id == playlist_id)).scalar():
+        raise HTTPException(404, "Playlist not found")
+    ids = [row[0] for row in db.query(models.PlaylistAudio.audio_id).filter(
+        models.PlaylistAudio.playlist_id == playlist_id
+    ).order_by(models.PlaylistAudio.order, models.PlaylistAudio.id)]
+    if not ids:
+        raise HTTPException(404, "Playlist is empty")
+    return get_download_audios(db, ids)
+
 def get_audio_file(db: Session, audio_id: int):
     audio = db.query(models.Audio).filter(models.Audio.id == audio_id).first()
     if not audio or not audio.file:
         raise HTTPException(status_code=404, detail="Audio file not found")
-    return get_file(audio.file)
+    response = get_file(audio.file)
+    analytics.record("play", audio_id)
+    return response
+
+def get_audio_stats(db: Session, audio_id: int, days: int):
+    since = datetime.now().date() - timedelta(days=days - 1)
+    rows = db.query(models.AudioDailyStats).filter(
+        models.AudioDailyStats.audio_id == audio_id,
+        models.AudioDailyStats.day >= since
+    ).order_by(models.AudioDailyStats.day).all()
+
+    columns = list(analytics.EVENT_COLUMNS.values())
+    daily = [{"day": row.day.isoformat(), **{column: getattr(row, column) for column in columns}} for row in rows]
+    totals = {column: sum(day[column] for day in daily) for column in columns}
+    return {"audio_id": audio_id, "since": since.isoformat(), "totals": totals, "daily": daily}
 
 def get_audio_file_v2(db: Session, audio_id: int):
     audio = db.query(models.Audio).filter(models.Audio.id == audio_id).first()
     if not audio or not audio.file:
         raise HTTPException(status_code=404, detail="Audio file not found")
     
-    file_path = Path(audio.file)
-    if not file_path.exists():
+    if not storage.exists(audio.file):
         raise HTTPException(status_code=404, detail="Audio file not found on server")
     
-    return FileResponse(
-        path=file_path,
-        filename=file_path.name,
+    return storage.response(
+        audio.file,
         media_type='application/octet-stream',
-        headers={
-            'Content-Disposition': f'attachment; filename="{file_path.name}"',
-            'Access-Control-Expose-Headers': 'Content-Disposition'
-        }
+        headers={'Access-Control-Expose-Headers': 'Content-Disposition'}
     )
 
 def get_audio_cover(db: Session, audio_id: int):
@@ -397,9 +580,62 @@ def search_audio(
     genres: str = None,
     instruments: str = None,
     keys: str = None,
-    loop: bool = None
+    loop: bool = None,
+    fields: tuple = None
     ):
-    query = db.query(models.Audio).join(models.Audio.instrument)
+    params = search_params(title, min_bpm, max_bpm, genres, instruments, keys, loop)
+    cache_key = (catalogue_version(db), params, fields)
+    audios = _search_cache.get(cache_key)
+    if audios is None:
+        audios = [projection.audio_dict(audio, fields) for audio in _search_query(db, params, fields).all()]
+        if len(audios) <= SEARCH_CACHE_MAX_ROWS:
+            _search_cache.set(cache_key, audios)
+
+    if not audios:
+        return []
+
+    counts_dict = get_favorites_counts(db, [audio["id"] for audio in audios])
+
+    results = []
+    for audio_dict in audios:
+        results.append({
+            "audio": audio_dict,
+            "favorites_count": counts_dict.get(audio_dict["id"], 0)
+        })
+
+    return results
+
+def _split_names(value: str):
+    if not value:
+        return None
+    names = sorted({name.strip().lower() for name in value.split(',') if name.strip()})
+    return tuple(names) or None
+
+def search_params(title, min_bpm, max_bpm, genres, instruments, keys, loop):
+    return (
+        title.strip().lower() if title and title.strip() else None,
+        min_bpm,
+        max_bpm,
+        _split_names(genres),
+        _split_names(instruments),
+        _split_names(keys),
+        loop
+    )
+
+def _search_query(db: Session, params: tuple, fields: tuple = None):
+    query = _apply_search_filters(db.query(models.Audio), params)
+    if fields is not None:
+        return query.options(*projection.audio_options(fields))
+    return query.options(
+        joinedload(models.Audio.genres),
+        joinedload(models.Audio.instrument),
+        joinedload(models.Audio.key),
+        joinedload(models.Audio.author)
+    )
+
+def _apply_search_filters(query, params: tuple):
+    title, min_bpm, max_bpm, genre_list, instrument_list, key_list, loop = params
+    query = query.join(models.Audio.instrument)
     filters = []
 
     if title:
@@ -413,12 +649,10 @@ def search_audio(
     if bpm_filters:
         filters.append(and_(*bpm_filters))
 
-    if instruments:
-        instrument_list = [i.strip().lower() for i in instruments.split(',')]
+    if instrument_list:
         filters.append(func.lower(models.Instrument.name).in_(instrument_list))
 
-    if genres:
-        genre_list = [g.strip().lower() for g in genres.split(',')]
+    if genre_list:
         subquery = exists().where(
             and_(
                 models.AudioGenre.audio_id == models.Audio.id,
@@ -427,10 +661,12 @@ def search_audio(
             ))
         filters.append(subquery)
 
-    if keys:
-        key_list = [k.strip().lower() for k in keys.split(',')]
+    if key_list:
         query = query.join(models.Audio.key)
-        filters.append(func.lower(models.Key.name).in_(key_list))
+        filters.append(or_(
+            func.lower(models.Key.name).in_(key_list),
+            models.Audio.key_id.in_(_matching_key_ids(query.session, key_list))
+        ))
 
     if loop is not None:
         filters.append(models.Audio.is_loop == loop)
@@ -438,19 +674,189 @@ def search_audio(
     if filters:
         query = query.filter(and_(*filters))
 
-    query = query.options(
-        joinedload(models.Audio.genres),
-        joinedload(models.Audio.instrument),
-        joinedload(models.Audio.key)
-    )
+    return query
 
-    audios = query.all()
+# =====================
+# Harmonic search
+# =====================
 
-    if not audios:
+COMPATIBLE_LIMIT = 100
+
+def search_compatible(
+    db: Session,
+    key: str = None,
+    bpm: int = None,
+    bpm_tolerance: int = 3,
+    half_double: bool = True,
+    limit: int = 20
+    ):
+    if key is None and bpm is None:
+        raise HTTPException(400, "Provide a key, a BPM, or both")
+    limit = max(1, min(limit, COMPATIBLE_LIMIT))
+
+    key_distances = None
+    tiers = [None]
+    if key is not None:
+        target = harmony.parse_key(key)
+        if target is None:
+            raise HTTPException(400, f"Unknown key '{key}'")
+        key_distances = harmony.compatible_key_ids(_reference_rows(db, models.Key), target)
+        if not key_distances:
+            return []
+        tiers = [
+            [key_id for key_id, distance in key_distances.items() if distance == tier]
+            for tier in sorted(set(key_distances.values()))
+        ]
+
+    tempos = []
+    if bpm is not None:
+        tempos = [(bpm, bpm_tolerance)]
+        if half_double:
+            tempos += [(bpm / 2, bpm_tolerance / 2), (bpm * 2, bpm_tolerance * 2)]
+
+    def rank(row):
+        key_distance = key_distances[row.key_id] if key_distances is not None else 0
+        tempo_distance = min(
+            (abs(row.bpm - tempo) / tempo for tempo, _ in tempos if tempo),
+            default=0
+        )
+        return key_distance, tempo_distance, row.id
+
+    # Каждый ярус тональностей и каждое окно темпа — отдельный индексный запрос (key_id, bpm)
+    # с сортировкой по близости темпа в SQL; лучшие `limit` из каждого сливаются по общему рангу
+    candidates = {}
+    for key_ids in tiers:
+        base = db.query(models.Audio.id, models.Audio.key_id, models.Audio.bpm)
+        if key_ids is not None:
+            base = base.filter(models.Audio.key_id.in_(key_ids))
+        if not tempos:
+            queries = [base.order_by(models.Audio.id)]
+        else:
+            queries = [
+                base.filter(models.Audio.bpm.between(tempo - tolerance, tempo + tolerance)).order_by(
+                    func.abs(models.Audio.bpm - tempo), models.Audio.id
+                )
+                for tempo, tolerance in tempos
+            ]
+        for query in queries:
+            for row in query.limit(limit):
+                candidates[row.id] = row
+        if len(candidates) >= limit:
+            break
+
+    ranked = sorted(candidates.values(), key=rank)[:limit]
+    if not ranked:
         return []
 
-    audio_ids = [audio.id for audio in audios]
+    items = get_audios_batch(db, [row.id for row in ranked])["items"]
+    ranks = {row.id: rank(row) for row in ranked}
+    return [
+        {**item, "key_distance": ranks[item["audio"]["id"]][0], "tempo_distance": round(ranks[item["audio"]["id"]][1], 4)}
+        for item in items
+    ]
+
+# =====================
+# Discover
+# =====================
+
+DISCOVER_LIMIT = 50
+DISCOVER_PROBE_BATCH = 500
+DISCOVER_MAX_PROBES = 20000
+DISCOVER_MAX_ID = 2 ** 63 - 1
+
+def _shuffle(seed: str, n: int):
+    # Сеть Фейстеля на 2^k с «прогулкой по циклу» даёт биекцию на [0, n) без хранения перестановки
+    bits = max(2, (n - 1).bit_length())
+    bits += bits % 2
+    half = bits // 2
+    mask = (1 << half) - 1
+    keys = [blake2b(f"{seed}:{r}".encode(), digest_size=16).digest() for r in range(4)]
+
+    def feistel(x: int) -> int:
+        left, right = x >> half, x & mask
+        for key in keys:
+            mixed = int.from_bytes(blake2b(right.to_bytes(8, "big"), key=key, digest_size=8).digest(), "big")
+            left, right = right, left ^ (mixed & mask)
+        return (left << half) | right
+
+    def permute(position: int) -> int:
+        x = feistel(position)
+        while x >= n:
+            x = feistel(x)
+        return x
+
+    return permute
+
+def discover_audios(
+    db: Session,
+    limit: int = 10,
+    seed: str = None,
+    cursor: str = None,
+    genres: str = None,
+    instruments: str = None,
+    keys: str = None,
+    loop: bool = None,
+    min_bpm: int = None,
+    max_bpm: int = None
+    ):
+    limit = max(1, min(limit, DISCOVER_LIMIT))
+
+    if cursor:
+        # Курсор несёт seed: без него следующая страница шла бы по другой перестановке
+        try:
+            cursor_seed, low, high, position = cursor.rsplit(":", 3)
+            low, high, position = int(low), int(high), int(position)
+        except ValueError:
+            raise HTTPException(400, "Invalid cursor")
+        if not cursor_seed or (seed and seed != cursor_seed):
+            raise HTTPException(400, "Invalid cursor")
+        if not (1 <= low <= high <= DISCOVER_MAX_ID and 0 <= position <= high - low + 1):
+            raise HTTPException(400, "Invalid cursor")
+        seed = cursor_seed
+    else:
+        seed = seed or uuid4().hex[:12]
+        low, high = db.query(func.min(models.Audio.id), func.max(models.Audio.id)).one()
+        if low is None:
+            return {"seed": seed, "items": [], "next_cursor": None}
+        position = 0
+
+    span = high - low + 1
+    permute = _shuffle(seed, span)
+    params = search_params(None, min_bpm, max_bpm, genres, instruments, keys, loop)
+
+    found = []
+    probes = 0
+    while len(found) < limit and position < span and probes < DISCOVER_MAX_PROBES:
+        batch = min(DISCOVER_PROBE_BATCH, span - position)
+        candidates = [low + permute(position + i) for i in range(batch)]
+        matched = {
+            row[0] for row in _apply_search_filters(db.query(models.Audio.id), params).filter(
+                models.Audio.id.in_(candidates)
+            )
+        }
+        probes += batch
+        for offset, candidate in enumerate(candidates):
+            if candidate in matched:
+                found.append(candidate)
+                if len(found) == limit:
+                    batch = offset + 1
+                    break
+        position += batch
+
+    items = get_audios_batch(db, found)["items"] if found else []
+    return {
+        "seed": seed,
+        "items": items,
+        "next_cursor": f"{seed}:{low}:{high}:{position}" if position < span else None
+    }
+
+def _matching_key_ids(db: Session, key_list) -> list:
+    targets = {harmony.parse_key(name) for name in key_list} - {None}
+    if not targets:
+        return []
+    return [row["id"] for row in _reference_rows(db, models.Key) if harmony.parse_key(row["name"]) in targets]
 
+def get_favorites_counts(db: Session, audio_ids: List[int]) -> dict:
     favorites_counts = db.query(
         models.Favorite.audio_id,
         func.count(models.Favorite.id).label('favorites_count')
@@ -458,18 +864,115 @@ def search_audio(
         models.Favorite.audio_id.in_(audio_ids)
     ).group_by(models.Favorite.audio_id).all()
 
-    counts_dict = {fc.audio_id: fc.favorites_count for fc in favorites_counts}
+    return {fc.audio_id: fc.favorites_count for fc in favorites_counts}
 
-    results = []
-    for audio in audios:
-        audio_dict = audio.to_dict()
-        favorites_count = counts_dict.get(audio.id, 0)
-        results.append({
-            "audio": audio_dict,
-            "favorites_count": favorites_count
-        })
+# =====================
+# Search cache
+# =====================
 
-    return results
+SEARCH_CACHE_MAX_ROWS = 2000
+
+_search_cache = LRUCache(max_entries=256, ttl=300)
+
+# Версия каталога — голова ленты изменений: общая для всех воркеров, любая запись её сдвигает
+def catalogue_version(db: Session) -> int:
+    return get_changes_cursor(db)
+
+# =====================
+# Change feed
+# =====================
+
+CHANGES_BATCH_LIMIT = 1000
+# Изменения пользователей пишутся только ради версии каталога, клиентам не отдаются
+FEED_ENTITIES = ("audio", "key", "genre", "instrument")
+
+def _next_change_id(db: Session) -> int:
+    # Строка-счётчик блокируется до коммита транзакции, поэтому id изменений
+    # становятся видимыми строго по порядку и курсор клиента не перепрыгнет незакоммиченный id
+    counter = db.query(models.CatalogueSequence).filter(
+        models.CatalogueSequence.name == "changes"
+    ).with_for_update().first()
+    if counter is None:
+        db.execute(insert(models.CatalogueSequence).prefix_with("IGNORE").values(
+            name="changes",
+            value=db.query(func.coalesce(func.max(models.CatalogueChange.id), 0)).scalar()
+        ))
+        counter = db.query(models.CatalogueSequence).filter(
+            models.CatalogueSequence.name == "changes"
+        ).with_for_update().one()
+    counter.value += 1
+    return counter.value
+
+def record_change(db: Session, entity: str, entity_id: int, op: str = "upsert"):
+    db.add(models.CatalogueChange(
+        id=_next_change_id(db),
+        entity=entity,
+        entity_id=entity_id,
+        op=op,
+        created_at=datetime.now()
+    ))
+
+def get_changes_cursor(db: Session) -> int:
+    return db.query(func.max(models.CatalogueChange.id)).scalar() or 0
+
+def get_changes(db: Session, since: int = 0, limit: int = 500):
+    limit = max(1, min(limit, CHANGES_BATCH_LIMIT))
+    rows = db.query(models.CatalogueChange).filter(
+        models.CatalogueChange.id > since
+    ).order_by(models.CatalogueChange.id).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    cursor = rows[-1].id if rows else since
+
+    latest = {}
+    for row in rows:
+        latest.pop((row.entity, row.entity_id), None)
+        latest[(row.entity, row.entity_id)] = row
+
+    upserts = {}
+    for entity in FEED_ENTITIES:
+        ids = [entity_id for (kind, entity_id), row in latest.items() if kind == entity and row.op == "upsert"]
+        if ids:
+            upserts[entity] = _compact_entities(db, entity, ids)
+
+    changes = []
+    for (entity, entity_id), row in latest.items():
+        if entity not in FEED_ENTITIES:
+            continue
+        if row.op == "delete":
+            changes.append({"cursor": row.id, "entity": entity, "id": entity_id, "op": "delete"})
+            continue
+        data = upserts.get(entity, {}).get(entity_id)
+        if data is None:
+            continue
+        changes.append({"cursor": row.id, "entity": entity, "id": entity_id, "op": "upsert", "data": data})
+
+    return {"changes": changes, "cursor": cursor, "has_more": has_more}
+
+def _compact_entities(db: Session, entity: str, ids: List[int]) -> dict:
+    if entity != "audio":
+        model = {"key": models.Key, "genre": models.Genre, "instrument": models.Instrument}[entity]
+        return {
+            row.id: {"id": row.id, "name": row.name}
+            for row in db.query(model.id, model.name).filter(model.id.in_(ids))
+        }
+
+    genre_ids = {}
+    for audio_id, genre_id in db.query(
+        models.AudioGenre.audio_id, models.AudioGenre.genre_id
+    ).filter(models.AudioGenre.audio_id.in_(ids)):
+        genre_ids.setdefault(audio_id, []).append(genre_id)
+
+    columns = (
+        models.Audio.id, models.Audio.title, models.Audio.cover, models.Audio.file,
+        models.Audio.duration, models.Audio.key_id, models.Audio.instrument_id,
+        models.Audio.bpm, models.Audio.is_loop, models.Audio.author_id
+    )
+    return {
+        row.id: {**row._asdict(), "genre_ids": sorted(genre_ids.get(row.id, []))}
+        for row in db.query(*columns).filter(models.Audio.id.in_(ids))
+    }
 
 def delete_audio(db: Session, audio_id: int, user_id: int):
     db_audio = db.query(models.Audio).filter(
@@ -486,11 +989,10 @@ def delete_audio(db: Session, audio_id: int, user_id: int):
     
     for file_path in [db_audio.file, db_audio.cover]:
         if file_path:
-            path = Path(file_path)
-            if path.exists():
-                path.unlink()
+            files.delete_after_commit(db, file_path)
     
     db.delete(db_audio)
+    record_change(db, "audio", audio_id, "delete")
     db.commit()
     return {"status": "Audio deleted"}
 
@@ -498,6 +1000,15 @@ def add_to_favorites(db: Session, user_id: int, audio_id: int = None, playlist_i
     if not any([audio_id, playlist_id]):
         raise HTTPException(400, "Must provide either audio or playlist ID")
     
+    already_added = db.query(exists().where(and_(
+        models.Favorite.user_id == user_id,
+        models.Favorite.audio_id == audio_id,
+        models.Favorite.playlist_id == playlist_id
+    ))).scalar()
+    if already_added:
+        return {"status": "added to favorites"}
+    
+    other_favorites = get_favorite_ids(db, user_id)["audios"] if audio_id else ()
     favorite = models.Favorite(
         user_id=user_id,
         audio_id=audio_id,
@@ -506,9 +1017,14 @@ def add_to_favorites(db: Session, user_id: int, audio_id: int = None, playlist_i
     
     db.add(favorite)
     db.commit()
+    
+    _favorites_cache.pop(user_id)
+    if audio_id:
+        analytics.record("favorite", audio_id)
+        recommend.record_favorite(audio_id, other_favorites)
     return {"status": "added to favorites"}
 
-def get_popular_audios(db: Session, limit: int):
+def get_popular_audios(db: Session, limit: int, fields: tuple = None):
     audio_counts = db.query(
         models.Audio.id,
         func.count(models.Favorite.id).label('favorites_count')
@@ -525,12 +1041,16 @@ def get_popular_audios(db: Session, limit: int):
     audio_ids = [ac[0] for ac in audio_counts]
     counts_dict = {ac[0]: ac[1] for ac in audio_counts}
 
-    audios = db.query(models.Audio).options(
-        joinedload(models.Audio.genres),
-        joinedload(models.Audio.instrument),
-        joinedload(models.Audio.key),
-        joinedload(models.Audio.author)
-    ).filter(models.Audio.id.in_(audio_ids)).all()
+    if fields is not None:
+        options = projection.audio_options(fields)
+    else:
+        options = [
+            joinedload(models.Audio.genres),
+            joinedload(models.Audio.instrument),
+            joinedload(models.Audio.key),
+            joinedload(models.Audio.author)
+        ]
+    audios = db.query(models.Audio).options(*options).filter(models.Audio.id.in_(audio_ids)).all()
 
     order_dict = {audio_id: idx for idx, audio_id in enumerate(audio_ids)}
     audios_sorted = sorted(audios, key=lambda a: order_dict[a.id])
@@ -538,7 +1058,7 @@ def get_popular_audios(db: Session, limit: int):
     results = []
     for audio in audios_sorted:
         results.append({
-            "audio": audio.to_dict(),
+            "audio": projection.audio_dict(audio, fields),
             "favorites_count": counts_dict[audio.id]
         })
 
@@ -554,7 +1074,7 @@ def create_playlist(db: Session, user_id: int, name: str, cover: UploadFile = No
     playlist = models.Playlist(
         name=name,
         author_id=db_user.id,
-        cover=save_file("./uploads/playlist/cover", cover) if cover else None
+        cover=save_file("./uploads/playlist/cover", cover, db) if cover else None
     )
     
     db.add(playlist)
@@ -562,32 +1082,110 @@ def create_playlist(db: Session, user_id: int, name: str, cover: UploadFile = No
     return {"id": playlist.id}
 
 def add_audio_to_playlist(db: Session, playlist_id: int, audio_id: int, user_id: int):
-    playlist = db.query(models.Playlist).filter(
-        models.Playlist.id == playlist_id,
-        models.Playlist.author_id == user_id
-    ).first()
-    
-    if not playlist:
-        raise HTTPException(404, "Playlist not found")
+    _get_own_playlist(db, playlist_id, user_id)
     
     audio = get_audio(db, audio_id)
     if not audio:
         raise HTTPException(404, "Audio not found")
     
-    max_order = db.query(func.max(models.PlaylistAudio.order)).filter(
-        models.PlaylistAudio.playlist_id == playlist_id
-    ).scalar() or 0
+    order = _next_playlist_order(db, playlist_id)
+    if order > PLAYLIST_ORDER_MAX:
+        _rebalance_playlist(db, playlist_id)
+        order = _next_playlist_order(db, playlist_id)
     
+    context = _playlist_context(db, playlist_id)
     playlist_audio = models.PlaylistAudio(
         playlist_id=playlist_id,
         audio_id=audio_id,
-        order=max_order + 1
+        order=order
     )
     
     db.add(playlist_audio)
     db.commit()
+    recommend.record_playlist_add([audio_id], context)
     return {"status": "added"}
 
+def add_audios_to_playlist(db: Session, playlist_id: int, audio_ids: List[int], user_id: int):
+    if not audio_ids:
+        raise HTTPException(400, "No audios to add")
+    if len(audio_ids) > PLAYLIST_BATCH_LIMIT:
+        raise HTTPException(400, f"At most {PLAYLIST_BATCH_LIMIT} audios per request")
+    _get_own_playlist(db, playlist_id, user_id)
+    
+    found = {row[0] for row in db.query(models.Audio.id).filter(models.Audio.id.in_(set(audio_ids)))}
+    missing = [audio_id for audio_id in audio_ids if audio_id not in found]
+    if missing:
+        raise HTTPException(404, f"Audio not found: {missing}")
+    
+    start = _next_playlist_order(db, playlist_id)
+    if start + PLAYLIST_ORDER_GAP * (len(audio_ids) - 1) > PLAYLIST_ORDER_MAX:
+        _rebalance_playlist(db, playlist_id)
+        start = _next_playlist_order(db, playlist_id)
+    
+    context = _playlist_context(db, playlist_id)
+    db.execute(insert(models.PlaylistAudio), [
+        {"playlist_id": playlist_id, "audio_id": audio_id, "order": start + PLAYLIST_ORDER_GAP * idx}
+        for idx, audio_id in enumerate(audio_ids)
+    ])
+    db.commit()
+    recommend.record_playlist_add(audio_ids, context)
+    return {"status": "added", "count": len(audio_ids)}
+
+def remove_audios_from_playlist(db: Session, playlist_id: int, audio_ids: List[int], user_id: int):
+    if not audio_ids:
+        raise HTTPException(400, "No audios to remove")
+    if len(audio_ids) > PLAYLIST_BATCH_LIMIT:
+        raise HTTPException(400, f"At most {PLAYLIST_BATCH_LIMIT} audios per request")
+    _get_own_playlist(db, playlist_id, user_id)
+    
+    removed = db.query(models.PlaylistAudio).filter(
+        models.PlaylistAudio.playlist_id == playlist_id,
+        models.PlaylistAudio.audio_id.in_(set(audio_ids))
+    ).delete(synchronize_session=False)
+    
+    db.commit()
+    return {"status": "audios removed", "count": removed}
+
+def get_playlist_audios(db: Session, playlist_id: int, limit: int = 50, cursor: str = None):
+    if not db.query(exists().where(models.Playlist.id == playlist_id)).scalar():
+        raise HTTPException(404, "Playlist not found")
+    limit = max(1, min(limit, PLAYLIST_PAGE_LIMIT))
+    
+    query = db.query(models.PlaylistAudio.order, models.PlaylistAudio.id, models.Audio).join(
+        models.Audio, models.Audio.id == models.PlaylistAudio.audio_id
+    ).filter(
+        models.PlaylistAudio.playlist_id == playlist_id
+    )
+    
+    if cursor:
+        try:
+            after_order, after_id = (int(part) for part in cursor.split(":"))
+        except ValueError:
+            raise HTTPException(400, "Invalid cursor")
+        query = query.filter(or_(
+            models.PlaylistAudio.order > after_order,
+            and_(models.PlaylistAudio.order == after_order, models.PlaylistAudio.id > after_id)
+        ))
+    
+    rows = query.options(
+        joinedload(models.Audio.genres),
+        joinedload(models.Audio.instrument),
+        joinedload(models.Audio.key),
+        joinedload(models.Audio.author)
+    ).order_by(
+        models.PlaylistAudio.order, models.PlaylistAudio.id
+    ).limit(limit + 1).all()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1][0]}:{rows[-1][1]}"
+    
+    return {
+        "items": [{"audio": audio.to_dict(), "order": order} for order, _, audio in rows],
+        "next_cursor": next_cursor
+    }
+
 def get_playlist(db: Session, playlist_id: int):
     return db.query(models.Playlist).options(
         joinedload(models.Playlist.audios)
@@ -605,10 +1203,7 @@ def delete_playlist(db: Session, playlist_id: int, user_id: int):
     db.query(models.PlaylistAudio).filter(models.PlaylistAudio.playlist_id == playlist_id).delete()
     db.query(models.Favorite).filter(models.Favorite.playlist_id == playlist_id).delete()
     
-    if db_playlist.cover:
-        path = Path(db_playlist.cover)
-        if path.exists():
-            path.unlink()
+    files.delete_after_commit(db, db_playlist.cover)
     
     db.delete(db_playlist)
     db.commit()
@@ -638,7 +1233,8 @@ def update_playlist(
     
     if name: playlist.name = name
     if cover: 
-        playlist.cover = save_file("./uploads/playlist/cover", cover)
+        files.delete_after_commit(db, playlist.cover)
+        playlist.cover = save_file("./uploads/playlist/cover", cover, db)
     
     db.commit()
     return playlist
@@ -649,27 +1245,127 @@ def remove_audio_from_playlist(
     audio_id: int,
     user_id: int
 ):
-    # Проверка прав доступа
-    playlist = db.query(models.Playlist).filter(
-        models.Playlist.id == playlist_id,
-        models.Playlist.author_id == user_id
-    ).first()
-    if not playlist:
-        raise HTTPException(404, "Playlist not found")
+    _get_own_playlist(db, playlist_id, user_id)
     
-    # Удаление связи
+    # Ключи порядка разреженные, поэтому остальные треки не перенумеровываются
     db.query(models.PlaylistAudio).filter(
         models.PlaylistAudio.playlist_id == playlist_id,
         models.PlaylistAudio.audio_id == audio_id
     ).delete()
     
-    # Обновление порядка треков
-    tracks = db.query(models.PlaylistAudio).filter(
-        models.PlaylistAudio.playlist_id == playlist_id
-    ).order_by(models.PlaylistAudio.order).all()
+    db.commit()
+    return {"status": "audio removed"}
+
+def move_audio_in_playlist(
+    db: Session,
+    playlist_id: int,
+    audio_id: int,
+    position: int,
+    user_id: int
+):
+    return reorder_playlist(db, playlist_id, [audio_id], position, user_id)
+
+def reorder_playlist(
+    db: Session,
+    playlist_id: int,
+    audio_ids: List[int],
+    position: int,
+    user_id: int
+):
+    _get_own_playlist(db, playlist_id, user_id)
+    if not audio_ids:
+        raise HTTPException(400, "No audios to move")
+    if len(audio_ids) > PLAYLIST_BATCH_LIMIT:
+        raise HTTPException(400, f"At most {PLAYLIST_BATCH_LIMIT} audios per request")
+    if len(audio_ids) != len(set(audio_ids)):
+        raise HTTPException(400, "Duplicate audio IDs")
     
-    for idx, track in enumerate(tracks):
-        track.order = idx + 1
+    tracks = {}
+    for track in db.query(models.PlaylistAudio).filter(
+        models.PlaylistAudio.playlist_id == playlist_id,
+        models.PlaylistAudio.audio_id.in_(audio_ids)
+    ).order_by(models.PlaylistAudio.order):
+        tracks.setdefault(track.audio_id, track)
+    
+    missing = [audio_id for audio_id in audio_ids if audio_id not in tracks]
+    if missing:
+        raise HTTPException(404, f"Audio not in playlist: {missing}")
+    moving = [tracks[audio_id] for audio_id in audio_ids]
+    
+    orders = _orders_at_position(db, playlist_id, position, moving)
+    if orders is None:
+        _rebalance_playlist(db, playlist_id, len(moving))
+        orders = _orders_at_position(db, playlist_id, position, moving)
+    if orders is None:
+        raise HTTPException(409, "Playlist is too large to reorder")
+    
+    for track, order in zip(moving, orders):
+        track.order = order
     
     db.commit()
-    return {"status": "audio removed"}
+    return {"status": "moved"}
+
+# =====================
+# Playlist ordering
+# =====================
+
+PLAYLIST_BATCH_LIMIT = 500
+PLAYLIST_PAGE_LIMIT = 200
+
+def _get_own_playlist(db: Session, playlist_id: int, user_id: int):
+    playlist = db.query(models.Playlist).filter(
+        models.Playlist.id == playlist_id,
+        models.Playlist.author_id == user_id
+    ).first()
+    if not playlist:
+        raise HTTPException(404, "Playlist not found")
+    return playlist
+
+def _next_playlist_order(db: Session, playlist_id: int) -> int:
+    max_order = db.query(func.max(models.PlaylistAudio.order)).filter(
+        models.PlaylistAudio.playlist_id == playlist_id
+    ).scalar() or 0
+    return max_order + PLAYLIST_ORDER_GAP
+
+def _orders_at_position(db: Session, playlist_id: int, position: int, moving: list):
+    position = max(position, 0)
+    moving_ids = [track.id for track in moving]
+    others = db.query(models.PlaylistAudio.order).filter(
+        models.PlaylistAudio.playlist_id == playlist_id,
+        models.PlaylistAudio.id.notin_(moving_ids)
+    ).order_by(models.PlaylistAudio.order)
+    
+    if position == 0:
+        before = None
+        after = others.limit(1).scalar()
+    else:
+        neighbours = [row[0] for row in others.offset(position - 1).limit(2)]
+        if not neighbours:
+            before = db.query(func.max(models.PlaylistAudio.order)).filter(
+                models.PlaylistAudio.playlist_id == playlist_id,
+                models.PlaylistAudio.id.notin_(moving_ids)
+            ).scalar()
+            after = None
+        else:
+            before = neighbours[0]
+            after = neighbours[1] if len(neighbours) > 1 else None
+    
+    return spread(before, after, len(moving))
+
+def _playlist_context(db: Session, playlist_id: int) -> list:
+    return [row[0] for row in db.query(models.PlaylistAudio.audio_id).filter(
+        models.PlaylistAudio.playlist_id == playlist_id
+    ).order_by(models.PlaylistAudio.order).limit(recommend.MAX_CONTEXT_ITEMS)]
+
+def _rebalance_playlist(db: Session, playlist_id: int, inserting: int = 1):
+    tracks = db.query(models.PlaylistAudio.id).filter(
+        models.PlaylistAudio.playlist_id == playlist_id
+    ).order_by(models.PlaylistAudio.order, models.PlaylistAudio.id).all()
+    gap = rebalance_gap(len(tracks), inserting)
+    if gap is None:
+        raise HTTPException(409, "Playlist is too large to reorder")
+    db.bulk_update_mappings(models.PlaylistAudio, [
+        {"id": track.id, "order": (idx + 1) * gap}
+        for idx, track in enumerate(tracks)
+    ])
+    db.flush()
@@ -0,0 +1,181 @@
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from time import perf_counter
+
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger("marblesound.diagnostics")
+
+ENABLED = os.getenv("MARBLESOUND_DIAGNOSTICS", "0").lower() in {"1", "true", "yes"}
+QUERY_BUDGET = int(os.getenv("MARBLESOUND_QUERY_BUDGET", "20"))
+REPEAT_THRESHOLD = int(os.getenv("MARBLESOUND_REPEAT_THRESHOLD", "5"))
+SLOW_QUERY_MS = float(os.getenv("MARBLESOUND_SLOW_QUERY_MS", "100"))
+MAX_SLOW_PER_ROUTE = 20
+
+_IN_LIST = re.compile(r"\(\s*(?:%s|\?|%\(\w+\)s)(?:\s*,\s*(?:%s|\?|%\(\w+\)s))*\s*\)")
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r"\s+")
+
+def statement_shape(statement: str) -> str:
+    shape = _STRING.sub("?", statement)
+    shape = _NUMBER.sub("?", shape)
+    shape = _IN_LIST.sub("(...)", shape)
+    return _SPACE.sub(" ", shape).strip()
+
+# =====================
+# Per-request trace
+# =====================
+
+class RequestTrace:
+    __slots__ = ("queries", "shapes", "slow")
+
+    def __init__(self):
+        self.queries = 0
+        self.shapes = Counter()
+        self.slow = []
+
+_current: ContextVar = ContextVar("marblesound_diagnostics_trace", default=None)
+
+class RouteReport:
+    def __init__(self):
+        self.requests = 0
+        self.over_budget = 0
+        self.max_queries = 0
+        self.repeated = Counter()
+        self.slow = {}
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "over_budget": self.over_budget,
+            "max_queries": self.max_queries,
+            "repeated": [
+                {"statement": shape, "requests": count}
+                for shape, count in self.repeated.most_common()
+            ],
+            "slow": sorted(self.slow.values(), key=lambda s: s["max_ms"], reverse=True),
+        }
+
+_reports = {}
+_explained = {}
+_lock = threading.Lock()
+
+def report():
+    with _lock:
+        return {route: r.to_dict() for route, r in sorted(_reports.items())}
+
+def reset():
+    with _lock:
+        _reports.clear()
+        _explained.clear()
+
+# =====================
+# Hooks
+# =====================
+
+def instrument_engine(engine):
+    if getattr(engine, "_marblesound_diagnostics", False):
+        return
+    engine._marblesound_diagnostics = True
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("diagnostics_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("diagnostics_start")
+        if not starts:
+            return
+        elapsed_ms = (perf_counter() - starts.pop()) * 1000
+        trace = _current.get()
+        if trace is None or conn.info.get("diagnostics_explain"):
+            return
+        trace.queries += 1
+        shape = statement_shape(statement)
+        trace.shapes[shape] += 1
+        if elapsed_ms >= SLOW_QUERY_MS:
+            trace.slow.append((shape, statement, None if executemany else parameters, elapsed_ms))
+
+def _explain(engine, statement, parameters):
+    if not statement.lstrip().upper().startswith("SELECT"):
+        return None
+    try:
+        with engine.connect() as conn:
+            conn.info["diagnostics_explain"] = True
+            try:
+                result = conn.exec_driver_sql("EXPLAIN " + statement, parameters or ())
+                return [dict(row._mapping) for row in result]
+            finally:
+                conn.info.pop("diagnostics_explain", None)
+    except Exception as e:
+        return [{"error": str(e)}]
+
+def _record(engine, route: str, trace: RequestTrace):
+    repeated = [(shape, count) for shape, count in trace.shapes.items() if count >= REPEAT_THRESHOLD]
+    over_budget = trace.queries > QUERY_BUDGET
+
+    if over_budget:
+        logger.warning("%s ran %d queries (budget %d)", route, trace.queries, QUERY_BUDGET)
+    for shape, count in repeated:
+        logger.warning("%s repeated a statement %d times (possible N+1): %s", route, count, shape)
+
+    to_explain = []
+    with _lock:
+        route_report = _reports.setdefault(route, RouteReport())
+        route_report.requests += 1
+        route_report.over_budget += over_budget
+        route_report.max_queries = max(route_report.max_queries, trace.queries)
+        for shape, _ in repeated:
+            route_report.repeated[shape] += 1
+        for shape, statement, parameters, elapsed_ms in trace.slow:
+            entry = route_report.slow.get(shape)
+            if entry is None:
+                if len(route_report.slow) >= MAX_SLOW_PER_ROUTE:
+                    continue
+                entry = route_report.slow[shape] = {"statement": shape, "count": 0, "max_ms": 0.0, "explain": None}
+                if shape not in _explained:
+                    _explained[shape] = None
+                    to_explain.append((shape, statement, parameters))
+            entry["count"] += 1
+            entry["max_ms"] = max(entry["max_ms"], round(elapsed_ms, 2))
+            entry["explain"] = _explained.get(shape)
+
+    for shape, statement, parameters in to_explain:
+        plan = _explain(engine, statement, parameters)
+        logger.warning("%s slow statement: %s\nEXPLAIN: %s", route, shape, plan)
+        with _lock:
+            _explained[shape] = plan
+            for route_report in _reports.values():
+                if shape in route_report.slow:
+                    route_report.slow[shape]["explain"] = plan
+
+# =====================
+# Middleware
+# =====================
+
+class DiagnosticsMiddleware:
+    def __init__(self, app, engine):
+        self.app = app
+        self.engine = engine
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace()
+        token = _current.set(trace)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            if trace.queries:
+                await run_in_threadpool(_record, self.engine, route, trace)
@@ -0,0 +1,66 @@
+import argparse
+import json
+import sys
+import zlib
+
+from sqlalchemy.orm import joinedload, selectinload
+
+import models
+from database import SessionLocal
+
+BATCH_SIZE = 500
+
+def iter_catalogue(db, after_id: int = 0, batch_size: int = BATCH_SIZE):
+    last_id = after_id
+    while True:
+        batch = db.query(models.Audio).options(
+            selectinload(models.Audio.genres),
+            joinedload(models.Audio.instrument),
+            joinedload(models.Audio.key),
+            joinedload(models.Audio.author)
+        ).filter(
+            models.Audio.id > last_id
+        ).order_by(models.Audio.id).limit(batch_size).all()
+
+        if not batch:
+            return
+        rows = [audio.to_dict() for audio in batch]
+        last_id = batch[-1].id
+        db.expunge_all()
+        yield rows
+
+def iter_ndjson(after_id: int = 0, compress: bool = False, batch_size: int = BATCH_SIZE):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    db = SessionLocal()
+    try:
+        for rows in iter_catalogue(db, after_id, batch_size):
+            chunk = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode()
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            # Каждая партия — короткая отдельная транзакция, соединение не держится открытым
+            db.rollback()
+            if chunk:
+                yield chunk
+    finally:
+        db.close()
+    if compressor is not None:
+        yield compressor.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the MarbleSound catalogue as NDJSON.")
+    parser.add_argument("--after-id", type=int, default=0, help="resume after this audio id")
+    parser.add_argument("--gzip", action="store_true", help="gzip the output")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    args = parser.parse_args()
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in iter_ndjson(args.after_id, args.gzip, args.batch_size):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import logging
+import os
+import queue
+import threading
+from itertools import islice
+from time import sleep, time
+
+from sqlalchemy import event
+
+import models
+from database import SessionLocal
+from storage import storage
+
+logger = logging.getLogger("marblesound.files")
+
+SWEEP_PREFIXES = {
+    "uploads/audio/file": models.Audio.file,
+    "uploads/audio/cover": models.Audio.cover,
+    "uploads/avatar": models.User.avatar,
+    "uploads/playlist/cover": models.Playlist.cover
+}
+# По умолчанию выключено: sweep запускается из cron (python files.py)
+# или в одном выделенном процессе с MARBLESOUND_SWEEP_INTERVAL > 0
+SWEEP_INTERVAL = float(os.getenv("MARBLESOUND_SWEEP_INTERVAL", "0"))
+SWEEP_GRACE_SECONDS = float(os.getenv("MARBLESOUND_SWEEP_GRACE", "3600"))
+SWEEP_BATCH_SIZE = 500
+SWEEP_BATCH_PAUSE = 0.1
+
+# =====================
+# Deferred deletion
+# =====================
+
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+def track_upload(db, key: str):
+    if key:
+        db.info.setdefault("pending_uploads", []).append(key)
+
+def delete_after_commit(db, key: str):
+    if key:
+        db.info.setdefault("pending_deletes", []).append(key)
+
+def discard_pending(db):
+    db.info.pop("pending_deletes", None)
+    for key in db.info.pop("pending_uploads", []):
+        enqueue_delete(key)
+
+def enqueue_delete(key: str):
+    _ensure_worker()
+    _queue.put(key)
+
+@event.listens_for(SessionLocal, "after_commit")
+def _after_commit(session):
+    session.info.pop("pending_uploads", None)
+    for key in session.info.pop("pending_deletes", []):
+        enqueue_delete(key)
+
+@event.listens_for(SessionLocal, "after_soft_rollback")
+def _after_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        discard_pending(session)
+
+def _ensure_worker():
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_delete_loop, name="file-deleter", daemon=True)
+            _worker.start()
+
+def _delete_loop():
+    while True:
+        key = _queue.get()
+        try:
+            if key is None:
+                return
+            storage.delete(key)
+        except Exception:
+            logger.exception("Failed to delete %s", key)
+        finally:
+            _queue.task_done()
+
+def shutdown():
+    if _worker is not None and _worker.is_alive():
+        _queue.put(None)
+        _worker.join(timeout=30)
+
+# =====================
+# Orphan sweeper
+# =====================
+
+def _referenced_keys(db, column, keys: list) -> set:
+    return {key for (key,) in db.query(column).filter(column.in_(keys))}
+
+def sweep(grace_seconds: float = SWEEP_GRACE_SECONDS, batch_size: int = SWEEP_BATCH_SIZE) -> int:
+    cutoff = time() - grace_seconds
+    removed = 0
+    db = SessionLocal()
+    try:
+        for prefix, column in SWEEP_PREFIXES.items():
+            keys = storage.iter_keys(prefix)
+            while True:
+                batch = list(islice(keys, batch_size))
+                if not batch:
+                    break
+                candidates = [key for key, modified in batch if modified < cutoff]
+                if candidates:
+                    referenced = _referenced_keys(db, column, candidates)
+                    db.rollback()
+                    for key in candidates:
+                        if key not in referenced:
+                            storage.delete(key)
+                            removed += 1
+                sleep(SWEEP_BATCH_PAUSE)
+    finally:
+        db.close()
+    if removed:
+        logger.info("Swept %d orphaned files", removed)
+    return removed
+
+def _sweep_loop(stop: threading.Event):
+    while not stop.wait(SWEEP_INTERVAL):
+        try:
+            sweep()
+        except Exception:
+            logger.exception("Orphan sweep failed")
+
+def start_sweeper() -> threading.Event:
+    stop = threading.Event()
+    if SWEEP_INTERVAL > 0:
+        threading.Thread(target=_sweep_loop, args=(stop,), name="orphan-sweeper", daemon=True).start()
+    return stop
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(sweep())
@@ -0,0 +1,69 @@
+import re
+
+NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+NOTE_PITCH = {"c": 0, "d": 2, "e": 4, "f": 5, "g": 7, "a": 9, "b": 11}
+MAJOR, MINOR = "major", "minor"
+
+_KEY_PATTERN = re.compile(r"^([a-g])\s*(#|♯|b|♭|sharp|flat)?\s*(major|maj|minor|min|m)?$")
+_CAMELOT_PATTERN = re.compile(r"^(1[0-2]|[1-9])\s*([ab])$")
+
+def parse_key(name: str):
+    if not name:
+        return None
+    text = name.strip().lower().replace("-", " ")
+    text = re.sub(r"\s+", " ", text)
+
+    camelot_match = _CAMELOT_PATTERN.match(text)
+    if camelot_match:
+        number, letter = int(camelot_match.group(1)), camelot_match.group(2)
+        return _from_camelot(number, MINOR if letter == "a" else MAJOR)
+
+    match = _KEY_PATTERN.match(text)
+    if not match:
+        return None
+    note, accidental, quality = match.groups()
+    pitch = NOTE_PITCH[note]
+    if accidental in {"#", "♯", "sharp"}:
+        pitch += 1
+    elif accidental in {"b", "♭", "flat"}:
+        pitch -= 1
+    mode = MINOR if quality in {"minor", "min", "m"} else MAJOR
+    return pitch % 12, mode
+
+def canonical_name(key) -> str:
+    pitch, mode = key
+    return f"{NOTE_NAMES[pitch]} {mode}"
+
+def camelot(key):
+    pitch, mode = key
+    major_pitch = pitch if mode == MAJOR else (pitch + 3) % 12
+    return (major_pitch * 7 + 7) % 12 + 1, "B" if mode == MAJOR else "A"
+
+def _from_camelot(number: int, mode: str):
+    major_pitch = ((number - 1 - 7) * 7) % 12
+    return (major_pitch if mode == MAJOR else (major_pitch - 3) % 12), mode
+
+ALL_KEYS = [(pitch, mode) for mode in (MAJOR, MINOR) for pitch in range(12)]
+
+def _distance(a, b):
+    number_a, letter_a = camelot(a)
+    number_b, letter_b = camelot(b)
+    step = min((number_a - number_b) % 12, (number_b - number_a) % 12)
+    if letter_a == letter_b:
+        return step if step <= 1 else None
+    return 1 if step == 0 else None
+
+# Для каждой тональности: совместимые тональности по кругу Камелота и расстояние (0 — та же)
+COMPATIBLE = {
+    key: {other: distance for other in ALL_KEYS if (distance := _distance(key, other)) is not None}
+    for key in ALL_KEYS
+}
+
+def compatible_key_ids(key_rows: list, target) -> dict:
+    compatible = COMPATIBLE[target]
+    result = {}
+    for row in key_rows:
+        parsed = parse_key(row["name"])
+        if parsed in compatible:
+            result[row["id"]] = compatible[parsed]
+    return result
@@ -1,14 +1,125 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from starlette.concurrency import run_in_threadpool
+
 from passlib.context import CryptContext
+from metrics import timed
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 pwd_context.update(bcrypt__default_rounds=6)
 
+HASH_WORKERS = int(os.getenv("MARBLESOUND_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Синхронные вызовы (проверка сессии в обычных эндпоинтах) занимают поток пула anyio (40 по умолчанию),
+# поэтому их очередь держится заметно меньше этого лимита; вход и регистрация ждут в event loop
+HASH_MAX_PENDING = int(os.getenv("MARBLESOUND_HASH_MAX_PENDING", str(min(HASH_WORKERS * 8, 16))))
+HASH_ADMISSION_TIMEOUT = float(os.getenv("MARBLESOUND_HASH_ADMISSION_TIMEOUT", "2"))
+
+class HasherBusy(Exception):
+    pass
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(1, HASH_MAX_PENDING))
+_async_slots = asyncio.Semaphore(max(1, HASH_MAX_PENDING))
+
+def _verify(plain_data, hashed_data):
+    return pwd_context.verify(plain_data, hashed_data)
+
+def _hash(data):
+    return pwd_context.hash(data)
+
+def _mp_context():
+    # fork из потока работающего сервера копирует чужие блокировки; forkserver/spawn безопасны
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=_mp_context())
+    return _pool
+
+def _reset_pool(broken):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def _run(fn, *args):
+    if HASH_WORKERS <= 0:
+        return fn(*args)
+    if not _slots.acquire(timeout=HASH_ADMISSION_TIMEOUT):
+        raise HasherBusy()
+    try:
+        for attempt in range(2):
+            pool = _get_pool()
+            try:
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # Дочерний процесс умер (например, OOM) — пересоздаём пул и повторяем один раз
+                _reset_pool(pool)
+                if attempt:
+                    raise
+    finally:
+        _slots.release()
+
+async def _run_async(fn, *args):
+    if HASH_WORKERS <= 0:
+        return await run_in_threadpool(fn, *args)
+    try:
+        await asyncio.wait_for(_async_slots.acquire(), HASH_ADMISSION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HasherBusy()
+    try:
+        for attempt in range(2):
+            pool = _get_pool()
+            try:
+                return await asyncio.wrap_future(pool.submit(fn, *args))
+            except BrokenProcessPool:
+                _reset_pool(pool)
+                if attempt:
+                    raise
+    finally:
+        _async_slots.release()
+
+def start():
+    if HASH_WORKERS > 0:
+        pool = _get_pool()
+        for future in [pool.submit(_hash, "warmup") for _ in range(HASH_WORKERS)]:
+            future.result()
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
 class Hasher():
     @staticmethod
     def verify_hash(plain_data, hashed_data):
-        return pwd_context.verify(plain_data, hashed_data)
+        with timed("bcrypt"):
+            return _run(_verify, plain_data, hashed_data)
 
     @staticmethod
     def get_hash(data):
-        return pwd_context.hash(data)
-    
\ No newline at end of file
+        with timed("bcrypt"):
+            return _run(_hash, data)
+
+    @staticmethod
+    async def verify_hash_async(plain_data, hashed_data):
+        with timed("bcrypt"):
+            return await _run_async(_verify, plain_data, hashed_data)
+
+    @staticmethod
+    async def get_hash_async(data):
+        with timed("bcrypt"):
+            return await _run_async(_hash, data)
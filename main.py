@@ -1,9 +1,27 @@
-from fastapi import FastAPI, HTTPException, Depends, File, UploadFile
+import os
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Request, Header
+from fastapi.responses import PlainTextResponse, StreamingResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
 from typing import Annotated, List
-import models
 from database import engine, SessionLocal
 from sqlalchemy.orm import Session
 import crud
+import metrics
+import diagnostics
+import coalesce
+import changefeed
+import export
+import zipstream
+import files
+import hashing
+import throttle
+import account_deletion
+import schema
+import recommend
+import analytics
+import uploads
+import projection
 
 tags_metadata = [
     {
@@ -18,37 +36,145 @@ tags_metadata = [
         "name": "Playlist control",
         "description": "Operations with playlists."
     },
+    {
+        "name": "Sync",
+        "description": "Incremental catalogue change feed for clients."
+    },
+    {
+        "name": "Service",
+        "description": "Monitoring and diagnostics."
+    },
 ]
 
-app = FastAPI(openapi_tags=tags_metadata)
-models.Base.metadata.create_all(bind=engine)
+WARM_POOL_CONNECTIONS = int(os.getenv("MARBLESOUND_WARM_CONNECTIONS", "5"))
+CREATE_SCHEMA = os.getenv("MARBLESOUND_CREATE_SCHEMA", "0").lower() in {"1", "true", "yes"}
+
+router = APIRouter()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(startup, app)
+    try:
+        yield
+    finally:
+        await run_in_threadpool(shutdown, app)
+
+def startup(app: FastAPI):
+    if CREATE_SCHEMA:
+        schema.create_schema(engine)
+    warm_connection_pool(WARM_POOL_CONNECTIONS)
+    db = SessionLocal()
+    try:
+        crud.warm_reference_caches(db)
+    finally:
+        db.close()
+    hashing.start()
+    account_deletion.resume()
+    app.state.sweeper_stop = files.start_sweeper()
+    app.state.recommend_stop = recommend.start()
+    analytics.start()
+    app.state.uploads_stop = uploads.start()
+
+def shutdown(app: FastAPI):
+    app.state.recommend_stop.set()
+    app.state.uploads_stop.set()
+    analytics.shutdown()
+    app.state.sweeper_stop.set()
+    files.shutdown()
+    hashing.shutdown()
+    engine.dispose()
+
+def warm_connection_pool(count: int):
+    connections = []
+    try:
+        for _ in range(min(count, engine.pool.size())):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+def create_app() -> FastAPI:
+    app = FastAPI(openapi_tags=tags_metadata, lifespan=lifespan)
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.instrument_engine(engine)
+    if diagnostics.ENABLED:
+        app.add_middleware(diagnostics.DiagnosticsMiddleware, engine=engine)
+        diagnostics.instrument_engine(engine)
+    app.add_exception_handler(hashing.HasherBusy, hasher_busy)
+    app.include_router(router)
+    return app
+
+def hasher_busy(request: Request, exc: hashing.HasherBusy):
+    return JSONResponse({"detail": "Server is busy, try again later"}, status_code=503, headers={"Retry-After": "1"})
+
+def _throttle(limiter: throttle.RateLimiter, key):
+    retry_after = limiter.hit(key)
+    if retry_after:
+        raise HTTPException(429, "Too many attempts", headers={"Retry-After": str(retry_after)})
+
+def _client_ip(request: Request) -> str:
+    return throttle.client_ip(request)
 
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
+        files.discard_pending(db)
         db.close()
 
 db = Annotated[Session, Depends(get_db)]
 
+def _zip_response(audios: list, filename: str) -> StreamingResponse:
+    entries = zipstream.build_entries(audios)
+    for entry in entries:
+        if entry["size"] is not None:
+            analytics.record("download", entry["audio"]["id"])
+    return StreamingResponse(
+        zipstream.iter_zip(entries),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def _favorites_response(request: Request, db: Session, user_id: int, results: list):
+    return projection.respond(request, crud.annotate_favorites(db, user_id, results))
+
+RECOMMEND_LIMIT = 50
+
+def _recommend_limit(limit: int) -> int:
+    return max(1, min(limit, RECOMMEND_LIMIT))
+
+def _recommendations(db: Session, scored: list, user_id: int = None) -> list:
+    if not scored:
+        return []
+    scores = dict(scored)
+    items = crud.get_audios_batch(db, list(scores))["items"]
+    items = [{**item, "score": round(scores[item["audio"]["id"]], 4)} for item in items]
+    return crud.annotate_favorites(db, user_id, items)
+
 # =====================
 # User control
 # =====================
 
-@app.post("/user/create/", status_code=201, tags=["User control"])
-def create_user(
+@router.get("/", include_in_schema=False)
+def home():
+    return "MarbleSound"
+
+@router.post("/user/create/", status_code=201, tags=["User control"])
+async def create_user(
     db: db, 
+    request: Request,
     username: str, 
     password: str
     ):
-    user = crud.get_user(db, crud.SearchBy.username, username=username)
+    _throttle(throttle.registration_by_ip, _client_ip(request))
+    user = await run_in_threadpool(crud.get_user, db, crud.SearchBy.username, username=username)
     
     if user:
         raise HTTPException(409)
-    return crud.create_user(username=username, password=password, db=db)
+    return await crud.create_user(username=username, password=password, db=db)
 
-@app.post("/user/logout/", status_code=200, tags=["User control"])
+@router.post("/user/logout/", status_code=200, tags=["User control"])
 def user_logout(
     db: db, 
     id: int, 
@@ -58,15 +184,27 @@ def user_logout(
         raise HTTPException(403)
     return crud.user_logout(db=db, id=id, session=session)
 
-@app.post("/user/login/", status_code=201, tags=["User control"])
-def user_login(
+@router.post("/user/login/", status_code=201, tags=["User control"])
+async def user_login(
     db: db, 
+    request: Request,
     username: str, 
     password: str
     ):
-    return crud.user_login(db=db, username=username, password=password)
+    ip = _client_ip(request)
+    _throttle(throttle.login_by_ip, ip)
+    failures_key = (username.lower(), ip)
+    retry_after = throttle.login_failures.check(failures_key)
+    if retry_after:
+        raise HTTPException(429, "Too many attempts", headers={"Retry-After": str(retry_after)})
+    try:
+        return await crud.user_login(db=db, username=username, password=password)
+    except HTTPException as e:
+        if e.status_code in {403, 404}:
+            throttle.login_failures.hit(failures_key)
+        raise
 
-@app.get("/user/", status_code=200, tags=["User control"])
+@router.get("/user/", status_code=200, tags=["User control"])
 def get_user(
     db: db, 
     search_by: crud.SearchBy, 
@@ -75,14 +213,14 @@ def get_user(
     ):
     return crud.get_user(db=db, search_by=search_by, username=username, id=id)
 
-@app.get("/users/", status_code=200, tags=["User control"])
+@router.get("/users/", status_code=200, tags=["User control"])
 def get_users(
     db: db, 
     username: str = None
     ):
     return crud.get_users(db=db, username=username)
 
-@app.put("/user/update/", status_code=202, tags=["User control"])
+@router.put("/user/update/", status_code=202, tags=["User control"])
 def update_user_data(
     db: db, 
     id: int, 
@@ -94,7 +232,7 @@ def update_user_data(
         raise HTTPException(403)
     return crud.update_user_data(db, id, username, description)
 
-@app.put("/user/update/avatar/", status_code=202, tags=["User control"])
+@router.put("/user/update/avatar/", status_code=202, tags=["User control"])
 def update_user_avatar(
     db: db, 
     id: int, 
@@ -105,33 +243,63 @@ def update_user_avatar(
         raise HTTPException(403)
     return crud.update_user_avatar(db, id, avatar)
 
-@app.get("/user/avatar/", status_code=200, tags=["User control"])
+@router.get("/user/avatar/", status_code=200, tags=["User control"])
 def get_user_avatar(
     db: db, 
     id: int
     ):
     return crud.get_user_avatar(db, id)
 
-@app.delete("/user/delete/", status_code=200, tags=["User control"])
+@router.delete("/user/delete/", status_code=202, tags=["User control"])
 def delete_user(
     db: db,
     id: int,
-    session
+    session: str
     ):
-    return crud.delete_user(db, id, session)
+    crud.delete_user(db, id, session)
+    return account_deletion.start(db, id)
 
-@app.get("/user/{user_id}/favorites", status_code=200, tags=["User control"])
+@router.get("/user/delete/{job_id}", status_code=200, tags=["User control"])
+def get_user_deletion_status(db: db, job_id: str):
+    job = account_deletion.get_job(db, job_id)
+    if job is None:
+        raise HTTPException(404, "Deletion job not found")
+    return job
+
+@router.get("/user/{user_id}/favorites", status_code=200, tags=["User control"])
 def get_user_favorites(db: db, user_id: int):
     return crud.get_user_favorites(db, user_id)
 
-@app.get("/user/{user_id}/audios", status_code=200, tags=["User control"])
+@router.get("/user/{user_id}/favorites/ids", status_code=200, tags=["User control"])
+def get_user_favorite_ids(db: db, user_id: int):
+    favorite_ids = crud.get_favorite_ids(db, user_id)
+    return {
+        "audios": sorted(favorite_ids["audios"]),
+        "playlists": sorted(favorite_ids["playlists"])
+    }
+
+@router.get("/user/{user_id}/audios", status_code=200, tags=["User control"])
 def get_user_audios(
     db: db,
-    user_id: int
+    request: Request,
+    user_id: int,
+    fields: str = None
+):
+    fields = projection.parse_fields(fields)
+    if fields is None:
+        return crud.get_user_audios(db, user_id)
+    return projection.respond(request, crud.get_user_audios(db, user_id, fields))
+
+@router.get("/user/{user_id}/for-you", status_code=200, tags=["User control"])
+def get_user_recommendations(
+    db: db,
+    user_id: int,
+    limit: int = 20
 ):
-    return crud.get_user_audios(db, user_id)
+    favorite_ids = crud.get_favorite_ids(db, user_id)["audios"]
+    return _recommendations(db, recommend.for_items(favorite_ids, _recommend_limit(limit)), user_id)
 
-@app.get("/user/check_session", status_code=200, tags=["User control"])
+@router.get("/user/check_session", status_code=200, tags=["User control"])
 def check_session(
     db: db,
     user_id: int,
@@ -140,7 +308,7 @@ def check_session(
     valid = crud.check_user_session(db, user_id, session)
     return {"valid": valid}
 
-@app.get("/user/{user_id}/playlists", status_code=200, tags=["User control"])
+@router.get("/user/{user_id}/playlists", status_code=200, tags=["User control"])
 def get_user_playlists(
     db: db,
     user_id: int
@@ -151,7 +319,7 @@ def get_user_playlists(
 # Audio control
 # =====================
 
-@app.post("/audio/create/", status_code=201, tags=["Audio control"])
+@router.post("/audio/create/", status_code=201, tags=["Audio control"])
 def create_audio(
     db: db, 
     id: int, 
@@ -169,53 +337,200 @@ def create_audio(
         raise HTTPException(403)
     return crud.create_audio(db, id, file, cover, title, is_loop, key, bpm, genre, instrument)
 
-@app.get("/audio/{audio_id}", status_code=200, tags=["Audio control"])
+@router.post("/audio/upload/", status_code=201, tags=["Audio control"])
+def create_upload(
+    db: db,
+    id: int,
+    session: str,
+    filename: str,
+    size: int
+    ):
+    if not crud.check_user_session(db, id, session):
+        raise HTTPException(403)
+    return uploads.create(db, id, filename, size)
+
+@router.get("/audio/upload/{upload_id}", status_code=200, tags=["Audio control"])
+def get_upload_status(db: db, upload_id: str):
+    return uploads.status(db, upload_id)
+
+@router.put("/audio/upload/{upload_id}", status_code=200, tags=["Audio control"])
+async def upload_chunk(
+    db: db,
+    request: Request,
+    upload_id: str,
+    offset: int,
+    x_chunk_sha256: Annotated[str, Header()] = None
+    ):
+    body = bytearray()
+    async for data in request.stream():
+        body.extend(data)
+        if len(body) > uploads.MAX_CHUNK_SIZE:
+            raise HTTPException(413, f"Chunks are limited to {uploads.MAX_CHUNK_SIZE} bytes")
+    return await run_in_threadpool(uploads.append, db, upload_id, offset, bytes(body), x_chunk_sha256)
+
+@router.post("/audio/upload/{upload_id}/finalize", status_code=201, tags=["Audio control"])
+def finalize_upload(
+    db: db,
+    upload_id: str,
+    id: int,
+    session: str,
+    title: str,
+    instrument: str,
+    is_loop: bool,
+    genre: List[str],
+    key: str = None,
+    bpm: int = None,
+    cover: UploadFile = None
+    ):
+    if not crud.check_user_session(db, id, session):
+        raise HTTPException(403)
+    staged = uploads.claim(db, upload_id, id)
+    try:
+        uploads.mark_done(db, upload_id)
+        created = crud.create_audio(db, id, staged, cover, title, is_loop, key, bpm, genre, instrument)
+    except BaseException:
+        uploads.release(db, upload_id)
+        raise
+    finally:
+        staged.close()
+    uploads.complete(upload_id)
+    return created
+
+@router.delete("/audio/upload/{upload_id}", status_code=200, tags=["Audio control"])
+def abort_upload(db: db, upload_id: str):
+    uploads.abort(db, upload_id)
+    return {"status": "Upload aborted"}
+
+@router.get("/audios/batch", status_code=200, tags=["Audio control"])
+def get_audios_batch(
+    db: db,
+    ids: str,
+    user_id: int = None
+    ):
+    try:
+        audio_ids = [int(i) for i in ids.split(',') if i.strip()]
+    except ValueError:
+        raise HTTPException(400, "ids must be a comma-separated list of integers")
+    batch = crud.get_audios_batch(db, audio_ids)
+    batch["items"] = crud.annotate_favorites(db, user_id, batch["items"])
+    return batch
+
+@router.get("/audios/download", tags=["Audio control"])
+def download_audios(
+    db: db,
+    ids: str
+    ):
+    try:
+        audio_ids = [int(i) for i in ids.split(',') if i.strip()]
+    except ValueError:
+        raise HTTPException(400, "ids must be a comma-separated list of integers")
+    return _zip_response(crud.get_download_audios(db, audio_ids), "marblesound-samples.zip")
+
+@router.get("/audio/{audio_id}", status_code=200, tags=["Audio control"])
 def get_audio(
     db: db, 
     audio_id: int = None
     ):
     return crud.get_audio(db, audio_id)
 
-@app.get("/audios/", status_code=200, tags=["Audio control"])
-def search_audio(
+@router.get("/audio/{audio_id}/recommended", status_code=200, tags=["Audio control"])
+def get_recommended_audios(
+    db: db,
+    audio_id: int,
+    limit: int = 10,
+    user_id: int = None
+    ):
+    return _recommendations(db, recommend.similar(audio_id, _recommend_limit(limit)), user_id)
+
+@router.get("/audios/discover", status_code=200, tags=["Audio control"])
+def discover_audios(
+    db: db,
+    limit: int = 10,
+    seed: str = None,
+    cursor: str = None,
+    genres: str = None,
+    instruments: str = None,
+    keys: str = None,
+    loop: bool = None,
+    min_bpm: int = None,
+    max_bpm: int = None,
+    user_id: int = None
+    ):
+    page = crud.discover_audios(db, limit, seed, cursor, genres, instruments, keys, loop, min_bpm, max_bpm)
+    page["items"] = crud.annotate_favorites(db, user_id, page["items"])
+    return page
+
+@router.get("/audios/compatible", status_code=200, tags=["Audio control"])
+def search_compatible_audios(
+    db: db,
+    key: str = None,
+    bpm: int = None,
+    bpm_tolerance: int = 3,
+    half_double: bool = True,
+    limit: int = 20,
+    user_id: int = None
+    ):
+    results = crud.search_compatible(db, key, bpm, bpm_tolerance, half_double, limit)
+    return crud.annotate_favorites(db, user_id, results)
+
+@router.get("/audios/", status_code=200, tags=["Audio control"])
+async def search_audio(
     db: db, 
+    request: Request,
     title: str = None, 
     min_bpm: int = None,
     max_bpm: int = None,
     genres: str = None, 
     instruments: str = None, 
     keys: str = None,
-    loop: bool = None
+    loop: bool = None,
+    user_id: int = None,
+    fields: str = None
     ):
-    return crud.search_audio(db, title, min_bpm, max_bpm, genres, instruments, keys, loop)
-
-@app.get("/genres/", status_code=200, tags=["Audio control"])
+    fields = projection.parse_fields(fields)
+    results = await coalesce.run(
+        "audios_search",
+        (crud.search_params(title, min_bpm, max_bpm, genres, instruments, keys, loop), fields),
+        lambda session: crud.search_audio(session, title, min_bpm, max_bpm, genres, instruments, keys, loop, fields),
+        db
+    )
+    return await run_in_threadpool(_favorites_response, request, db, user_id, results)
+
+@router.get("/genres/", status_code=200, tags=["Audio control"])
 def get_genres(db: db):
     return crud.get_genre(db)
 
-@app.get("/keys/", status_code=200, tags=["Audio control"])
+@router.get("/keys/", status_code=200, tags=["Audio control"])
 def get_all_keys(db: db):
     return crud.get_all_keys(db)
 
-@app.get("/instruments/", status_code=200, tags=["Audio control"])
+@router.get("/instruments/", status_code=200, tags=["Audio control"])
 def get_all_instruments(db: db):
     return crud.get_all_instruments(db)
 
-@app.get("/audio/{audio_id}/file", tags=["Audio control"])
+@router.get("/audio/{audio_id}/file", tags=["Audio control"])
 def get_audio_file(
     db: db,
     audio_id: int
     ):
     return crud.get_audio_file(db, audio_id)
 
-@app.get("/audio/{audio_id}/cover", tags=["Audio control"])
+@router.get("/audio/{audio_id}/stats", tags=["Audio control"])
+def get_audio_stats(
+    db: db,
+    audio_id: int,
+    days: int = 30
+    ):
+    return crud.get_audio_stats(db, audio_id, max(1, min(days, 365)))
+
+@router.get("/audio/{audio_id}/cover", tags=["Audio control"])
 def get_audio_cover(
     db: db,
     audio_id: int
     ):
     return crud.get_audio_cover(db, audio_id)
 
-@app.delete("/audio/delete/{audio_id}", status_code=200, tags=["Audio control"])
+@router.delete("/audio/delete/{audio_id}", status_code=200, tags=["Audio control"])
 def delete_audio(
     db: db,
     audio_id: int,
@@ -226,7 +541,7 @@ def delete_audio(
         raise HTTPException(403)
     return crud.delete_audio(db, audio_id, id)
 
-@app.post("/favorite/audio/{audio_id}", status_code=201, tags=["Audio control"])
+@router.post("/favorite/audio/{audio_id}", status_code=201, tags=["Audio control"])
 def add_audio_to_favorites(
     db: db,
     audio_id: int,
@@ -237,11 +552,29 @@ def add_audio_to_favorites(
         raise HTTPException(403)
     return crud.add_to_favorites(db, user_id=user_id, audio_id=audio_id)
 
-@app.get("/audios/popular", status_code=200, tags=["Audio control"])
-def get_popular_audios(db: db, limit: int = 10):
-    return crud.get_popular_audios(db, limit)
-
-@app.put("/audio/update/{audio_id}", status_code=200, tags=["Audio control"])
+@router.get("/audios/popular", status_code=200, tags=["Audio control"])
+async def get_popular_audios(db: db, request: Request, limit: int = 10, user_id: int = None, fields: str = None):
+    fields = projection.parse_fields(fields)
+    results = await coalesce.run(
+        "audios_popular",
+        (limit, fields),
+        lambda session: crud.get_popular_audios(session, limit, fields),
+        db
+    )
+    return await run_in_threadpool(_favorites_response, request, db, user_id, results)
+
+@router.get("/audios/export", tags=["Audio control"])
+def export_audios(after_id: int = 0, gzip: bool = False):
+    headers = {"Content-Disposition": 'attachment; filename="catalogue.ndjson"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        export.iter_ndjson(after_id, compress=gzip),
+        media_type="application/x-ndjson",
+        headers=headers
+    )
+
+@router.put("/audio/update/{audio_id}", status_code=200, tags=["Audio control"])
 def update_audio(
     db: db,
     audio_id: int,
@@ -258,7 +591,7 @@ def update_audio(
         raise HTTPException(403)
     return crud.update_audio(db, audio_id, id, title, key, bpm, genres, instrument, is_loop)
 
-@app.delete("/favorite/audio/{audio_id}", status_code=200, tags=["Audio control"])
+@router.delete("/favorite/audio/{audio_id}", status_code=200, tags=["Audio control"])
 def remove_audio_from_favorites(
     db: db,
     audio_id: int,
@@ -273,7 +606,7 @@ def remove_audio_from_favorites(
 # Playlist control
 # =====================
 
-@app.post("/playlist/create/", status_code=201, tags=["Playlist control"])
+@router.post("/playlist/create/", status_code=201, tags=["Playlist control"])
 def create_playlist(
     db: db, 
     id: int, 
@@ -285,7 +618,7 @@ def create_playlist(
         raise HTTPException(403)
     return crud.create_playlist(db, id, name, cover)
 
-@app.post("/playlist/{playlist_id}/add/", status_code=200, tags=["Playlist control"])
+@router.post("/playlist/{playlist_id}/add/", status_code=200, tags=["Playlist control"])
 def add_to_playlist(
     db: db,
     playlist_id: int,
@@ -297,14 +630,58 @@ def add_to_playlist(
         raise HTTPException(403)
     return crud.add_audio_to_playlist(db, playlist_id, audio_id, id)
 
-@app.get("/playlist/{playlist_id}/", status_code=200, tags=["Playlist control"])
+@router.get("/playlist/{playlist_id}/", status_code=200, tags=["Playlist control"])
 def get_playlist(
     db: db, 
     playlist_id: int
     ):
     return crud.get_playlist(db, playlist_id)
 
-@app.delete("/playlist/delete/{playlist_id}", status_code=200, tags=["Playlist control"])
+@router.get("/playlist/{playlist_id}/audios", status_code=200, tags=["Playlist control"])
+def get_playlist_audios(
+    db: db,
+    playlist_id: int,
+    limit: int = 50,
+    cursor: str = None,
+    user_id: int = None
+    ):
+    page = crud.get_playlist_audios(db, playlist_id, limit, cursor)
+    page["items"] = crud.annotate_favorites(db, user_id, page["items"])
+    return page
+
+@router.post("/playlist/{playlist_id}/add/batch/", status_code=200, tags=["Playlist control"])
+def add_audios_to_playlist(
+    db: db,
+    playlist_id: int,
+    audio_ids: List[int],
+    id: int,
+    session: str
+    ):
+    if not crud.check_user_session(db, id, session):
+        raise HTTPException(403)
+    return crud.add_audios_to_playlist(db, playlist_id, audio_ids, id)
+
+@router.post("/playlist/{playlist_id}/remove/batch/", status_code=200, tags=["Playlist control"])
+def remove_audios_from_playlist(
+    db: db,
+    playlist_id: int,
+    audio_ids: List[int],
+    id: int,
+    session: str
+    ):
+    if not crud.check_user_session(db, id, session):
+        raise HTTPException(403)
+    return crud.remove_audios_from_playlist(db, playlist_id, audio_ids, id)
+
+@router.get("/playlist/{playlist_id}/download", tags=["Playlist control"])
+def download_playlist(
+    db: db,
+    playlist_id: int
+    ):
+    audios = crud.get_playlist_download_audios(db, playlist_id)
+    return _zip_response(audios, f"marblesound-playlist-{playlist_id}.zip")
+
+@router.delete("/playlist/delete/{playlist_id}", status_code=200, tags=["Playlist control"])
 def delete_playlist(
     db: db,
     playlist_id: int,
@@ -315,11 +692,11 @@ def delete_playlist(
         raise HTTPException(403)
     return crud.delete_playlist(db, playlist_id, id)
 
-@app.get("/playlists/popular", status_code=200, tags=["Playlist control"])
+@router.get("/playlists/popular", status_code=200, tags=["Playlist control"])
 def get_popular_playlists(db: db, limit: int = 10):
     return crud.get_popular_playlists(db, limit)
 
-@app.put("/playlist/update/{playlist_id}", status_code=200, tags=["Playlist control"])
+@router.put("/playlist/update/{playlist_id}", status_code=200, tags=["Playlist control"])
 def update_playlist(
     db: db,
     playlist_id: int,
@@ -332,7 +709,7 @@ def update_playlist(
         raise HTTPException(403)
     return crud.update_playlist(db, playlist_id, id, name, cover)
 
-@app.delete("/playlist/{playlist_id}/remove/{audio_id}", status_code=200, tags=["Playlist control"])
+@router.delete("/playlist/{playlist_id}/remove/{audio_id}", status_code=200, tags=["Playlist control"])
 def remove_audio_from_playlist(
     db: db,
     playlist_id: int,
@@ -343,3 +720,73 @@ def remove_audio_from_playlist(
     if not crud.check_user_session(db, id, session):
         raise HTTPException(403)
     return crud.remove_audio_from_playlist(db, playlist_id, audio_id, id)
+
+@router.put("/playlist/{playlist_id}/move/{audio_id}", status_code=200, tags=["Playlist control"])
+def move_audio_in_playlist(
+    db: db,
+    playlist_id: int,
+    audio_id: int,
+    position: int,
+    id: int,
+    session: str
+):
+    if not crud.check_user_session(db, id, session):
+        raise HTTPException(403)
+    return crud.move_audio_in_playlist(db, playlist_id, audio_id, position, id)
+
+@router.put("/playlist/{playlist_id}/reorder/", status_code=200, tags=["Playlist control"])
+def reorder_playlist(
+    db: db,
+    playlist_id: int,
+    audio_ids: List[int],
+    id: int,
+    session: str,
+    position: int = 0
+):
+    if not crud.check_user_session(db, id, session):
+        raise HTTPException(403)
+    return crud.reorder_playlist(db, playlist_id, audio_ids, position, id)
+
+# =====================
+# Sync
+# =====================
+
+@router.get("/changes", status_code=200, tags=["Sync"])
+def get_changes(
+    db: db,
+    since: int = None,
+    limit: int = 500
+):
+    if since is None:
+        return {"changes": [], "cursor": crud.get_changes_cursor(db), "has_more": False}
+    return crud.get_changes(db, since, limit)
+
+@router.get("/changes/stream", tags=["Sync"])
+def stream_changes(
+    request: Request,
+    since: int = None,
+    last_event_id: str = Header(None)
+):
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    if since is None:
+        raise HTTPException(400, "since is required")
+    return StreamingResponse(
+        changefeed.stream_changes(request, since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# =====================
+# Service
+# =====================
+
+@router.get("/metrics", tags=["Service"], response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/diagnostics", status_code=200, tags=["Service"])
+def get_diagnostics():
+    if not diagnostics.ENABLED:
+        raise HTTPException(404)
+    return diagnostics.report()
@@ -0,0 +1,229 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1024, 16384, 131072, 1048576, 8388608, 33554432, 134217728, 536870912)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+# =====================
+# Metric types
+# =====================
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @staticmethod
+    def _format_labels(names, values, extra: str = ""):
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{self._format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self._values.items()]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = self._format_labels(self.labels, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = self._format_labels(self.labels, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+# =====================
+# Registry
+# =====================
+
+REQUEST_LATENCY = Histogram(
+    "marblesound_request_duration_seconds", "Request latency by route.", ("method", "route", "status"))
+REQUESTS_IN_FLIGHT = Gauge(
+    "marblesound_requests_in_flight", "Requests currently being served.")
+REQUEST_QUERIES = Histogram(
+    "marblesound_request_db_queries", "SQL statements executed per request.", ("route",), COUNT_BUCKETS)
+REQUEST_DB_TIME = Histogram(
+    "marblesound_request_db_seconds", "Total SQL time per request.", ("route",))
+RESPONSE_BYTES = Counter(
+    "marblesound_response_bytes_total", "Response body bytes sent by route.", ("route",))
+UPLOAD_BYTES = Histogram(
+    "marblesound_upload_bytes", "Request body size of uploads by route.", ("route",), SIZE_BUCKETS)
+SECTION_TIME = Histogram(
+    "marblesound_section_seconds", "Time spent in instrumented sections (bcrypt, pydub, disk).", ("section",))
+
+REGISTRY = [
+    REQUEST_LATENCY,
+    REQUESTS_IN_FLIGHT,
+    REQUEST_QUERIES,
+    REQUEST_DB_TIME,
+    RESPONSE_BYTES,
+    UPLOAD_BYTES,
+    SECTION_TIME,
+]
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# =====================
+# Per-request state
+# =====================
+
+class RequestStats:
+    __slots__ = ("queries", "db_time", "received", "sent")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.received = 0
+        self.sent = 0
+
+_current: ContextVar = ContextVar("marblesound_request_stats", default=None)
+
+def current_stats():
+    return _current.get()
+
+@contextmanager
+def timed(section: str):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        SECTION_TIME.observe(perf_counter() - start, section)
+
+def instrument_engine(engine):
+    if getattr(engine, "_marblesound_metrics", False):
+        return
+    engine._marblesound_metrics = True
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("metrics_start")
+        if not starts:
+            return
+        elapsed = perf_counter() - starts.pop()
+        stats = _current.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+
+# =====================
+# Middleware
+# =====================
+
+UPLOAD_METHODS = {"POST", "PUT", "PATCH"}
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        status = [500]
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                stats.received += len(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            elif message["type"] == "http.response.body":
+                stats.sent += len(message.get("body", b""))
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = perf_counter()
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            elapsed = perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            _current.reset(token)
+
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            REQUEST_LATENCY.observe(elapsed, method, path, status[0])
+            REQUEST_QUERIES.observe(stats.queries, path)
+            REQUEST_DB_TIME.observe(stats.db_time, path)
+            if stats.sent:
+                RESPONSE_BYTES.inc(stats.sent, path)
+            if method in UPLOAD_METHODS and stats.received:
+                UPLOAD_BYTES.observe(stats.received, path)
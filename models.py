@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String, DateTime, Text, ForeignKey, Float 
+from sqlalchemy import BigInteger, Boolean, Column, Integer, String, DateTime, Date, Text, ForeignKey, Float, Index
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -24,6 +24,9 @@ class UserHashedData(Base):
 
 class Audio(Base):
     __tablename__ = "audios"
+    __table_args__ = (
+        Index("ix_audios_key_bpm", "key_id", "bpm"),
+    )
 
     id = Column(Integer, autoincrement=True, primary_key=True, index=True)
     title = Column(Text, nullable=False)
@@ -104,12 +107,15 @@ class Playlist(Base):
     name = Column(Text, nullable=False)
     cover = Column(String(2048))
     author_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    audios = relationship("Audio", secondary="playlistaudio", back_populates="playlists")
+    audios = relationship("Audio", secondary="playlistaudio", back_populates="playlists", order_by="PlaylistAudio.order")
     favorite = relationship("Favorite", backref="playlists")
 
 class PlaylistAudio(Base):
     __tablename__ = "playlistaudio"
-    
+    __table_args__ = (
+        Index("ix_playlistaudio_playlist_order", "playlist_id", "order"),
+    )
+
     id = Column(Integer, autoincrement=True, primary_key=True)
     playlist_id = Column(Integer, ForeignKey("playlists.id"))
     audio_id = Column(Integer, ForeignKey("audios.id"))
@@ -118,9 +124,66 @@ class PlaylistAudio(Base):
 
 class Favorite(Base):
     __tablename__ = "favorites"
+    __table_args__ = (
+        Index("ix_favorites_user_audio", "user_id", "audio_id"),
+    )
 
     id = Column(Integer, autoincrement=True, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     audio_id = Column(Integer, ForeignKey("audios.id"))
     playlist_id = Column(Integer, ForeignKey("playlists.id"))
 
+
+class CatalogueChange(Base):
+    __tablename__ = "catalogue_changes"
+
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    entity = Column(String(32), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String(16), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+
+class CatalogueSequence(Base):
+    __tablename__ = "catalogue_sequences"
+
+    name = Column(String(32), primary_key=True)
+    value = Column(Integer, nullable=False)
+
+
+class UserDeletionJob(Base):
+    __tablename__ = "user_deletion_jobs"
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    status = Column(String(16), nullable=False)
+    error = Column(Text)
+    deleted = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    filename = Column(String(255), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    status = Column(String(16), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True)
+
+
+class AudioDailyStats(Base):
+    __tablename__ = "audio_daily_stats"
+
+    # Без внешнего ключа: счётчики пишутся пачками и не должны мешать удалению аудио
+    audio_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    plays = Column(Integer, nullable=False, default=0)
+    downloads = Column(Integer, nullable=False, default=0)
+    favorites_added = Column(Integer, nullable=False, default=0)
+    favorites_removed = Column(Integer, nullable=False, default=0)
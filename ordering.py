@@ -0,0 +1,20 @@
+PLAYLIST_ORDER_GAP = 1024
+PLAYLIST_ORDER_MAX = 2**31 - 1
+
+def spread(before, after, count: int, gap: int = PLAYLIST_ORDER_GAP):
+    # Открытые края получают зазор не меньше count + 1, иначе шаг округлится до нуля
+    gap = max(gap, count + 1)
+    slots = count + 1
+    low = before if before is not None else (after if after is not None else 0) - slots * gap
+    high = after if after is not None else low + slots * gap
+    step = (high - low) // slots
+    if step < 1 or low < -PLAYLIST_ORDER_MAX or high > PLAYLIST_ORDER_MAX:
+        return None
+    return [low + step * (i + 1) for i in range(count)]
+
+def rebalance_gap(total: int, inserting: int):
+    # Зазор после перестройки: между любыми соседями должно поместиться `inserting` треков
+    gap = max(PLAYLIST_ORDER_GAP, inserting + 1)
+    if total * gap > PLAYLIST_ORDER_MAX:
+        gap = PLAYLIST_ORDER_MAX // max(total, 1)
+    return gap if gap >= inserting + 1 else None
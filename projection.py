@@ -0,0 +1,83 @@
+import msgpack
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+from sqlalchemy.orm import joinedload, load_only
+
+import models
+
+# =====================
+# Sparse fieldsets
+# =====================
+
+AUDIO_FIELDS = {
+    "id": lambda audio: audio.id,
+    "title": lambda audio: audio.title,
+    "cover": lambda audio: audio.cover,
+    "file": lambda audio: audio.file,
+    "duration": lambda audio: audio.duration,
+    "key": lambda audio: audio.key.name if audio.key else None,
+    "instrument": lambda audio: audio.instrument.name if audio.instrument else None,
+    "bpm": lambda audio: audio.bpm,
+    "is_loop": lambda audio: audio.is_loop,
+    "author_id": lambda audio: audio.author_id,
+    "genres": lambda audio: [genre.name for genre in audio.genres],
+    "author": lambda audio: {
+        "id": audio.author.id,
+        "username": audio.author.username,
+        "avatar": audio.author.avatar
+    } if audio.author else None
+}
+
+# Какие колонки и связи нужны для каждого поля
+_COLUMNS = {
+    "key": models.Audio.key_id,
+    "instrument": models.Audio.instrument_id,
+    "author": models.Audio.author_id
+}
+_RELATIONSHIPS = {
+    "key": models.Audio.key,
+    "instrument": models.Audio.instrument,
+    "genres": models.Audio.genres,
+    "author": models.Audio.author
+}
+
+def parse_fields(value: str):
+    if not value:
+        return None
+    requested = {name.strip() for name in value.split(",") if name.strip()}
+    unknown = requested - AUDIO_FIELDS.keys()
+    if unknown:
+        raise HTTPException(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+    requested.add("id")
+    return tuple(name for name in AUDIO_FIELDS if name in requested)
+
+def audio_options(fields: tuple) -> list:
+    columns = {models.Audio.id}
+    for name in fields:
+        column = _COLUMNS.get(name)
+        if column is None and name not in _RELATIONSHIPS:
+            column = getattr(models.Audio, name)
+        if column is not None:
+            columns.add(column)
+    options = [load_only(*columns)]
+    options += [joinedload(_RELATIONSHIPS[name]) for name in fields if name in _RELATIONSHIPS]
+    return options
+
+def audio_dict(audio, fields: tuple = None) -> dict:
+    if fields is None:
+        return audio.to_dict()
+    return {name: AUDIO_FIELDS[name](audio) for name in fields}
+
+# =====================
+# Content negotiation
+# =====================
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+def respond(request: Request, payload):
+    accept = request.headers.get("accept", "")
+    headers = {"Vary": "Accept"}
+    if any(media_type in accept for media_type in MSGPACK_TYPES):
+        return Response(msgpack.packb(payload, use_bin_type=True), media_type=MSGPACK_TYPES[0], headers=headers)
+    # Данные уже из примитивов — jsonable_encoder не нужен
+    return JSONResponse(payload, headers=headers)
@@ -0,0 +1,202 @@
+import heapq
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from itertools import groupby
+from math import sqrt
+
+import models
+from database import SessionLocal
+
+logger = logging.getLogger("marblesound.recommend")
+
+MAX_CONTEXT_ITEMS = 200
+NEIGHBOURS = 50
+# Индекс строится офлайн (python recommend.py из cron), приложение только подгружает снимок.
+# Перестройка внутри процесса включается явно и нужна разве что для одного выделенного воркера
+REBUILD_INTERVAL = float(os.getenv("MARBLESOUND_RECOMMEND_REBUILD", "0"))
+RELOAD_INTERVAL = float(os.getenv("MARBLESOUND_RECOMMEND_RELOAD", "600"))
+SNAPSHOT_PATH = os.getenv("MARBLESOUND_RECOMMEND_SNAPSHOT", "")
+
+class CooccurrenceIndex:
+    def __init__(self):
+        self._pairs = {}
+        self._counts = {}
+        self._neighbours = {}
+        self._lock = threading.Lock()
+
+    def add_context(self, items):
+        items = list(dict.fromkeys(items))[:MAX_CONTEXT_ITEMS]
+        with self._lock:
+            for item in items:
+                self._counts[item] = self._counts.get(item, 0) + 1
+            for i, item in enumerate(items):
+                row = self._pairs.setdefault(item, {})
+                for other in items[i + 1:]:
+                    row[other] = row.get(other, 0) + 1
+                    other_row = self._pairs.setdefault(other, {})
+                    other_row[item] = other_row.get(item, 0) + 1
+
+    def add_to_context(self, item: int, context):
+        context = [other for other in dict.fromkeys(context) if other != item][:MAX_CONTEXT_ITEMS]
+        with self._lock:
+            self._counts[item] = self._counts.get(item, 0) + 1
+            row = self._pairs.setdefault(item, {})
+            for other in context:
+                row[other] = row.get(other, 0) + 1
+                other_row = self._pairs.setdefault(other, {})
+                other_row[item] = other_row.get(item, 0) + 1
+                self._neighbours.pop(other, None)
+            self._neighbours.pop(item, None)
+
+    def similar(self, item: int, limit: int = NEIGHBOURS) -> list:
+        neighbours = self._neighbours.get(item)
+        if neighbours is None:
+            with self._lock:
+                row = dict(self._pairs.get(item, {}))
+                counts = self._counts
+                item_count = counts.get(item, 0)
+                scored = [
+                    (together / sqrt(item_count * counts[other]), other)
+                    for other, together in row.items()
+                    if item_count and counts.get(other)
+                ]
+            neighbours = [(other, score) for score, other in heapq.nlargest(NEIGHBOURS, scored)]
+            self._neighbours[item] = neighbours
+        return neighbours[:limit]
+
+    def for_items(self, items, limit: int = 20) -> list:
+        seen = set(items)
+        scores = {}
+        for item in seen:
+            for other, score in self.similar(item):
+                if other not in seen:
+                    scores[other] = scores.get(other, 0.0) + score
+        return heapq.nlargest(limit, scores.items(), key=lambda pair: pair[1])
+
+# =====================
+# Building
+# =====================
+
+def _contexts(rows):
+    for _, group in groupby(rows, key=lambda row: row[0]):
+        yield [row[1] for row in group]
+
+def build(db) -> CooccurrenceIndex:
+    built = CooccurrenceIndex()
+    favorites = db.query(models.Favorite.user_id, models.Favorite.audio_id).filter(
+        models.Favorite.audio_id.isnot(None)
+    ).order_by(models.Favorite.user_id, models.Favorite.id).yield_per(5000)
+    for items in _contexts(favorites):
+        built.add_context(items)
+
+    playlists = db.query(models.PlaylistAudio.playlist_id, models.PlaylistAudio.audio_id).order_by(
+        models.PlaylistAudio.playlist_id, models.PlaylistAudio.order
+    ).yield_per(5000)
+    for items in _contexts(playlists):
+        built.add_context(items)
+    return built
+
+index = CooccurrenceIndex()
+
+def rebuild():
+    global index
+    db = SessionLocal()
+    try:
+        index = build(db)
+    finally:
+        db.close()
+    if SNAPSHOT_PATH:
+        save(SNAPSHOT_PATH)
+
+def save(path: str):
+    with index._lock:
+        data = {"pairs": index._pairs, "counts": index._counts}
+        payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".recommend-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+_loaded_mtime = None
+
+def load(path: str) -> bool:
+    global index, _loaded_mtime
+    if not path or not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    loaded = CooccurrenceIndex()
+    loaded._pairs = data["pairs"]
+    loaded._counts = data["counts"]
+    index = loaded
+    _loaded_mtime = mtime
+    return True
+
+def _reload_if_changed():
+    if SNAPSHOT_PATH and os.path.exists(SNAPSHOT_PATH) and os.path.getmtime(SNAPSHOT_PATH) != _loaded_mtime:
+        load(SNAPSHOT_PATH)
+        logger.info("Loaded recommendation snapshot %s", SNAPSHOT_PATH)
+
+def _rebuild_loop(stop: threading.Event, initial: bool):
+    if initial:
+        try:
+            rebuild()
+        except Exception:
+            logger.exception("Initial recommendation build failed")
+    while not stop.wait(REBUILD_INTERVAL):
+        try:
+            rebuild()
+        except Exception:
+            logger.exception("Recommendation rebuild failed")
+
+def _reload_loop(stop: threading.Event):
+    while not stop.wait(RELOAD_INTERVAL):
+        try:
+            _reload_if_changed()
+        except Exception:
+            logger.exception("Recommendation snapshot reload failed")
+
+def start() -> threading.Event:
+    stop = threading.Event()
+    loaded = load(SNAPSHOT_PATH)
+    if REBUILD_INTERVAL > 0:
+        threading.Thread(target=_rebuild_loop, args=(stop, not loaded), name="recommend-rebuild", daemon=True).start()
+    elif SNAPSHOT_PATH and RELOAD_INTERVAL > 0:
+        threading.Thread(target=_reload_loop, args=(stop,), name="recommend-reload", daemon=True).start()
+    if not loaded and REBUILD_INTERVAL <= 0:
+        logger.warning("No recommendation snapshot loaded; run python recommend.py to build one")
+    return stop
+
+# =====================
+# Incremental updates
+# =====================
+
+def record_favorite(audio_id: int, other_favorites):
+    index.add_to_context(audio_id, other_favorites)
+
+def record_playlist_add(audio_ids, playlist_audio_ids):
+    context = list(playlist_audio_ids)
+    for audio_id in audio_ids:
+        index.add_to_context(audio_id, context)
+        context.append(audio_id)
+
+def similar(audio_id: int, limit: int) -> list:
+    return index.similar(audio_id, limit)
+
+def for_items(items, limit: int) -> list:
+    return index.for_items(items, limit)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if not SNAPSHOT_PATH:
+        raise SystemExit("Set MARBLESOUND_RECOMMEND_SNAPSHOT to the snapshot file path")
+    rebuild()
+    logger.info("Wrote %s", SNAPSHOT_PATH)
@@ -0,0 +1,22 @@
+import logging
+
+from sqlalchemy import inspect
+
+import models
+from database import engine as default_engine
+
+logger = logging.getLogger("marblesound.schema")
+
+def create_schema(engine=default_engine):
+    models.Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("Creating index %s on %s", index.name, table.name)
+                index.create(bind=engine)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    create_schema()
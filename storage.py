@@ -0,0 +1,249 @@
+import io
+import os
+import shutil
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote
+
+from fastapi.responses import FileResponse, RedirectResponse
+
+COPY_CHUNK_SIZE = 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+
+# =====================
+# Local filesystem
+# =====================
+
+class LocalStorage:
+    def __init__(self, root: str = None):
+        self.root = Path(root) if root else None
+
+    def _path(self, key: str) -> Path:
+        return (self.root or Path.cwd()) / key
+
+    def save(self, key: str, fileobj):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as buffer:
+            shutil.copyfileobj(fileobj, buffer, COPY_CHUNK_SIZE)
+
+    def open(self, key: str):
+        return self._path(key).open("rb")
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def size(self, key: str):
+        path = self._path(key)
+        return path.stat().st_size if path.is_file() else None
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def response(self, key: str, media_type: str = "multipart/form-data", headers: dict = None):
+        path = self._path(key)
+        return FileResponse(path=path, filename=path.name, media_type=media_type, headers=headers)
+
+    def iter_keys(self, prefix: str):
+        root = self.root or Path.cwd()
+        base = root / prefix
+        if not base.is_dir():
+            return
+        for path in base.rglob("*"):
+            if path.is_file():
+                yield path.relative_to(root).as_posix(), path.stat().st_mtime
+
+# =====================
+# S3-compatible object store
+# =====================
+
+def _is_not_found(error: Exception) -> bool:
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in {"404", "NoSuchKey", "NotFound"}
+
+class S3Storage:
+    def __init__(self, bucket: str, client=None, prefix: str = "", presign_seconds: int = 3600,
+                 part_size: int = PART_SIZE):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", endpoint_url=os.getenv("MARBLESOUND_S3_ENDPOINT") or None)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.presign_seconds = presign_seconds
+        self.part_size = part_size
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def save(self, key: str, fileobj):
+        object_key = self._key(key)
+        chunk = fileobj.read(self.part_size)
+        if len(chunk) < self.part_size:
+            self.client.put_object(Bucket=self.bucket, Key=object_key, Body=chunk)
+            return
+
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=object_key)["UploadId"]
+        parts = []
+        try:
+            while chunk:
+                part = self.client.upload_part(
+                    Bucket=self.bucket, Key=object_key, UploadId=upload_id,
+                    PartNumber=len(parts) + 1, Body=chunk
+                )
+                parts.append({"PartNumber": len(parts) + 1, "ETag": part["ETag"]})
+                chunk = fileobj.read(self.part_size)
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=object_key, UploadId=upload_id,
+                MultipartUpload={"Parts": parts}
+            )
+        except BaseException:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=object_key, UploadId=upload_id)
+            raise
+
+    def open(self, key: str):
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"]
+
+    def size(self, key: str):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))["ContentLength"]
+        except Exception as e:
+            if _is_not_found(e):
+                return None
+            raise
+
+    def exists(self, key: str) -> bool:
+        return self.size(key) is not None
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def iter_keys(self, prefix: str):
+        start_after = ""
+        while True:
+            page = self.client.list_objects_v2(
+                Bucket=self.bucket, Prefix=self._key(prefix), StartAfter=start_after, MaxKeys=1000
+            )
+            contents = page.get("Contents", [])
+            for item in contents:
+                yield item["Key"][len(self.prefix):], item["LastModified"].timestamp()
+            if not page.get("IsTruncated") or not contents:
+                return
+            start_after = contents[-1]["Key"]
+
+    def response(self, key: str, media_type: str = None, headers: dict = None):
+        url = self.client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self._key(key),
+                "ResponseContentDisposition": f"attachment; filename=\"{Path(key).name}\""
+            },
+            ExpiresIn=self.presign_seconds
+        )
+        return RedirectResponse(url, status_code=307, headers=headers)
+
+# =====================
+# In-process S3 fake
+# =====================
+
+class MemoryS3Error(Exception):
+    def __init__(self, code: str, message: str = ""):
+        super().__init__(message or code)
+        self.response = {"Error": {"Code": code, "Message": message or code}}
+
+class MemoryS3Client:
+    def __init__(self):
+        self._objects = {}
+        self._uploads = {}
+        self._lock = threading.Lock()
+        self._next_upload = 0
+
+    def put_object(self, Bucket, Key, Body):
+        data = Body.read() if hasattr(Body, "read") else bytes(Body)
+        with self._lock:
+            self._objects[(Bucket, Key)] = (data, datetime.now(timezone.utc))
+        return {"ETag": f'"{hash(data) & 0xffffffff:08x}"'}
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            entry = self._objects.get((Bucket, Key))
+        if entry is None:
+            raise MemoryS3Error("NoSuchKey")
+        return {"Body": io.BytesIO(entry[0]), "ContentLength": len(entry[0])}
+
+    def head_object(self, Bucket, Key):
+        with self._lock:
+            entry = self._objects.get((Bucket, Key))
+        if entry is None:
+            raise MemoryS3Error("404")
+        return {"ContentLength": len(entry[0]), "LastModified": entry[1]}
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            self._objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", StartAfter="", MaxKeys=1000, **kwargs):
+        with self._lock:
+            keys = sorted(
+                (key, entry) for (bucket, key), entry in self._objects.items()
+                if bucket == Bucket and key.startswith(Prefix) and key > StartAfter
+            )
+        contents = [
+            {"Key": key, "Size": len(data), "LastModified": modified}
+            for key, (data, modified) in keys[:MaxKeys]
+        ]
+        return {"Contents": contents, "KeyCount": len(contents), "IsTruncated": len(keys) > MaxKeys}
+
+    def create_multipart_upload(self, Bucket, Key):
+        with self._lock:
+            self._next_upload += 1
+            upload_id = str(self._next_upload)
+            self._uploads[upload_id] = (Bucket, Key, {})
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        data = Body.read() if hasattr(Body, "read") else bytes(Body)
+        with self._lock:
+            if UploadId not in self._uploads:
+                raise MemoryS3Error("NoSuchUpload")
+            self._uploads[UploadId][2][PartNumber] = data
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self._lock:
+            upload = self._uploads.pop(UploadId, None)
+            if upload is None:
+                raise MemoryS3Error("NoSuchUpload")
+            parts = upload[2]
+            data = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+            self._objects[(Bucket, Key)] = (data, datetime.now(timezone.utc))
+        return {"Key": Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+        return {}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return f"memory://{Params['Bucket']}/{quote(Params['Key'])}?expires={ExpiresIn}"
+
+# =====================
+# Configuration
+# =====================
+
+def _from_env():
+    backend = os.getenv("MARBLESOUND_STORAGE", "local").lower()
+    if backend == "local":
+        return LocalStorage(os.getenv("MARBLESOUND_STORAGE_ROOT") or None)
+    bucket = os.getenv("MARBLESOUND_S3_BUCKET", "marblesound")
+    prefix = os.getenv("MARBLESOUND_S3_PREFIX", "")
+    if backend == "s3":
+        return S3Storage(bucket, prefix=prefix)
+    if backend == "memory":
+        return S3Storage(bucket, client=MemoryS3Client(), prefix=prefix)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+storage = _from_env()
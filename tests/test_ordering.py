@@ -0,0 +1,40 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ordering import PLAYLIST_ORDER_GAP, PLAYLIST_ORDER_MAX, rebalance_gap, spread
+
+def _assert_between(orders, before, after):
+    assert orders == sorted(set(orders))
+    if before is not None:
+        assert orders[0] > before
+    if after is not None:
+        assert orders[-1] < after
+
+def test_spread_between_neighbours():
+    orders = spread(1024, 2048, 3)
+    assert len(orders) == 3
+    _assert_between(orders, 1024, 2048)
+
+def test_spread_open_ends():
+    _assert_between(spread(None, 1024, 5), None, 1024)
+    _assert_between(spread(4096, None, 5), 4096, None)
+    assert len(spread(None, None, 2)) == 2
+
+def test_spread_exhausted_gap_returns_none():
+    assert spread(10, 11, 1) is None
+
+def test_rebalance_fits_large_moves():
+    for count in (1, 500, 1023, 1024, 5000):
+        gap = rebalance_gap(total=count + 10, inserting=count)
+        orders = spread(gap, 2 * gap, count)
+        assert orders is not None
+        _assert_between(orders, gap, 2 * gap)
+
+def test_open_end_fits_more_than_default_gap():
+    count = PLAYLIST_ORDER_GAP * 2
+    _assert_between(spread(None, 1024, count), None, 1024)
+
+def test_rebalance_gap_overflow():
+    assert rebalance_gap(PLAYLIST_ORDER_MAX, 2) is None
@@ -0,0 +1,69 @@
+import os
+from ipaddress import ip_address, ip_network
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+from cache import LRUCache
+
+class RateLimiter:
+    def __init__(self, capacity: int, per_seconds: float, max_keys: int = 100000):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self._buckets = LRUCache(max_entries=max_keys)
+        self._lock = Lock()
+
+    def _tokens(self, key, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def _retry_after(self, tokens: float) -> int:
+        return max(1, ceil((1 - tokens) / self.rate))
+
+    def check(self, key) -> int:
+        with self._lock:
+            tokens = self._tokens(key, monotonic())
+        return self._retry_after(tokens) if tokens < 1 else 0
+
+    def hit(self, key) -> int:
+        now = monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now)
+            if tokens < 1:
+                self._buckets.set(key, (tokens, now))
+                return self._retry_after(tokens)
+            self._buckets.set(key, (tokens - 1, now))
+            return 0
+
+# Неудачные попытки считаются по паре (имя, IP): чужие ошибки не блокируют вход владельцу аккаунта
+login_failures = RateLimiter(capacity=5, per_seconds=60)
+login_by_ip = RateLimiter(capacity=30, per_seconds=60)
+registration_by_ip = RateLimiter(capacity=10, per_seconds=600)
+
+# =====================
+# Client address
+# =====================
+
+TRUSTED_PROXIES = [
+    ip_network(network.strip())
+    for network in os.getenv("MARBLESOUND_TRUSTED_PROXIES", "").split(",")
+    if network.strip()
+]
+
+def _is_trusted(address: str) -> bool:
+    try:
+        ip = ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+def client_ip(request) -> str:
+    address = request.client.host if request.client else "unknown"
+    if not _is_trusted(address):
+        return address
+    # Идём по X-Forwarded-For справа налево и берём первый адрес, который не наш прокси
+    forwarded = [part.strip() for part in request.headers.get("x-forwarded-for", "").split(",") if part.strip()]
+    for hop in reversed(forwarded):
+        if not _is_trusted(hop):
+            return hop
+    return forwarded[0] if forwarded else address
@@ -0,0 +1,238 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from contextlib import closing
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import monotonic
+from uuid import uuid4
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+
+import models
+from database import SessionLocal
+from storage import storage
+
+logger = logging.getLogger("marblesound.uploads")
+
+STAGING_PREFIX = "uploads/staging"
+MAX_UPLOAD_SIZE = int(os.getenv("MARBLESOUND_UPLOAD_MAX_SIZE", str(2 * 1024 ** 3)))
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 8 * 1024 * 1024
+SESSION_TTL = float(os.getenv("MARBLESOUND_UPLOAD_TTL", str(24 * 3600)))
+FINALIZE_TIMEOUT = 600
+ALLOWED_EXTENSIONS = {".wav", ".mp3", ".aiff"}
+
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+_CHUNK_NAME = re.compile(r"(\d{16})-(\d+)$")
+
+# Минимальная замена UploadFile для crud.create_audio: имя и открытый файл
+class StagedFile:
+    def __init__(self, filename: str, file):
+        self.filename = filename
+        self.file = file
+
+    def close(self):
+        self.file.close()
+
+# =====================
+# Chunks
+# =====================
+
+# Куски лежат в общем хранилище (uploads/staging/<id>/<offset>-<length>), сессия — в БД,
+# поэтому запросы одной загрузки могут попадать на разные узлы за балансировщиком
+
+def _prefix(upload_id: str) -> str:
+    return f"{STAGING_PREFIX}/{upload_id}/"
+
+def _chunks(upload_id: str):
+    chunks = []
+    for key, _ in storage.iter_keys(_prefix(upload_id)):
+        match = _CHUNK_NAME.search(key)
+        if match:
+            chunks.append((int(match.group(1)), int(match.group(2)), key))
+    # Для повторов одного и того же offset берётся самый длинный кусок
+    chunks.sort(key=lambda chunk: (chunk[0], -chunk[1]))
+
+    received, chain = 0, []
+    for offset, length, key in chunks:
+        if offset == received:
+            chain.append(key)
+            received += length
+        elif offset > received:
+            break
+    return received, chain
+
+def _delete_chunks(upload_id: str):
+    for key, _ in list(storage.iter_keys(_prefix(upload_id))):
+        storage.delete(key)
+
+# =====================
+# Sessions
+# =====================
+
+def _get_session(db, upload_id: str, status: str = "open") -> models.UploadSession:
+    if not _UPLOAD_ID.match(upload_id):
+        raise HTTPException(404, "Upload not found")
+    session = db.query(models.UploadSession).filter(models.UploadSession.id == upload_id).first()
+    if session is None or session.status == "done":
+        raise HTTPException(404, "Upload not found")
+    if status is not None and session.status != status:
+        raise HTTPException(409, "Upload is being finalized")
+    return session
+
+def create(db, user_id: int, filename: str, size: int) -> dict:
+    extension = Path(filename).suffix.lower()
+    if extension not in ALLOWED_EXTENSIONS:
+        raise HTTPException(400, f"Unsupported file type {extension} - {filename}")
+    if size <= 0 or size > MAX_UPLOAD_SIZE:
+        raise HTTPException(413, f"Upload size must be between 1 and {MAX_UPLOAD_SIZE} bytes")
+
+    now = datetime.now()
+    session = models.UploadSession(
+        id=uuid4().hex,
+        user_id=user_id,
+        filename=Path(filename).name,
+        size=size,
+        status="open",
+        created_at=now,
+        updated_at=now
+    )
+    db.add(session)
+    db.commit()
+    return {"upload_id": session.id, "offset": 0, "size": size, "chunk_size": CHUNK_SIZE}
+
+def status(db, upload_id: str) -> dict:
+    session = _get_session(db, upload_id, status=None)
+    received, _ = _chunks(upload_id)
+    return {"upload_id": upload_id, "offset": received, "size": session.size}
+
+def append(db, upload_id: str, offset: int, data: bytes, checksum: str = None) -> dict:
+    session = _get_session(db, upload_id)
+    if checksum is not None and hashlib.sha256(data).hexdigest() != checksum.lower():
+        raise HTTPException(400, "Chunk checksum mismatch")
+    if not data:
+        raise HTTPException(400, "Empty chunk")
+
+    received, _ = _chunks(upload_id)
+    if offset != received:
+        raise HTTPException(409, "Offset does not match received size", headers={"Upload-Offset": str(received)})
+    if received + len(data) > session.size:
+        raise HTTPException(413, "Chunk exceeds declared upload size")
+
+    storage.save(f"{_prefix(upload_id)}{offset:016d}-{len(data)}", io.BytesIO(data))
+    session.updated_at = datetime.now()
+    db.commit()
+    return {"upload_id": upload_id, "offset": received + len(data), "size": session.size}
+
+def claim(db, upload_id: str, user_id: int) -> StagedFile:
+    session = _get_session(db, upload_id, status=None)
+    if session.user_id != user_id:
+        raise HTTPException(403)
+
+    # Атомарный захват: из двух одновременных finalize дальше проходит только один
+    now = datetime.now()
+    claimed = db.query(models.UploadSession).filter(
+        models.UploadSession.id == upload_id,
+        or_(
+            models.UploadSession.status == "open",
+            and_(
+                models.UploadSession.status == "finalizing",
+                models.UploadSession.updated_at < now - timedelta(seconds=FINALIZE_TIMEOUT)
+            )
+        )
+    ).update({"status": "finalizing", "updated_at": now}, synchronize_session=False)
+    db.commit()
+    if claimed != 1:
+        raise HTTPException(409, "Upload is being finalized")
+
+    try:
+        received, chain = _chunks(upload_id)
+        if received != session.size:
+            raise HTTPException(409, "Upload is incomplete", headers={"Upload-Offset": str(received)})
+        assembled = tempfile.TemporaryFile()
+        heartbeat = monotonic()
+        for key in chain:
+            with closing(storage.open(key)) as chunk:
+                shutil.copyfileobj(chunk, assembled, CHUNK_SIZE)
+            # Долгая сборка продлевает захват, иначе другой finalize перехватит сессию по таймауту
+            if monotonic() - heartbeat > FINALIZE_TIMEOUT / 4:
+                _touch(db, upload_id)
+                heartbeat = monotonic()
+        assembled.seek(0)
+    except BaseException:
+        release(db, upload_id)
+        raise
+    return StagedFile(session.filename, assembled)
+
+def _touch(db, upload_id: str):
+    db.query(models.UploadSession).filter(models.UploadSession.id == upload_id).update(
+        {"updated_at": datetime.now()}, synchronize_session=False
+    )
+    db.commit()
+
+def release(db, upload_id: str):
+    db.rollback()
+    db.query(models.UploadSession).filter(models.UploadSession.id == upload_id).update(
+        {"status": "open", "updated_at": datetime.now()}, synchronize_session=False
+    )
+    db.commit()
+
+def mark_done(db, upload_id: str):
+    # Без commit: статус фиксируется той же транзакцией, что и созданный Audio. Блокировка строки
+    # до этого commit не даёт перехватившему по таймауту finalize создать дубликат
+    db.query(models.UploadSession).filter(models.UploadSession.id == upload_id).update(
+        {"status": "done", "updated_at": datetime.now()}, synchronize_session=False
+    )
+
+def complete(upload_id: str):
+    # Audio уже создан; оставшиеся куски подберёт purge_expired
+    try:
+        _delete_chunks(upload_id)
+    except Exception:
+        logger.exception("Failed to delete chunks of upload %s", upload_id)
+
+def abort(db, upload_id: str):
+    session = _get_session(db, upload_id)
+    db.delete(session)
+    db.commit()
+    _delete_chunks(upload_id)
+
+# =====================
+# Expiry
+# =====================
+
+def purge_expired(ttl: float = SESSION_TTL) -> int:
+    db = SessionLocal()
+    try:
+        upload_ids = [row[0] for row in db.query(models.UploadSession.id).filter(
+            models.UploadSession.updated_at < datetime.now() - timedelta(seconds=ttl)
+        )]
+        for upload_id in upload_ids:
+            _delete_chunks(upload_id)
+            db.query(models.UploadSession).filter(models.UploadSession.id == upload_id).delete()
+            db.commit()
+    finally:
+        db.close()
+    if upload_ids:
+        logger.info("Purged %d expired uploads", len(upload_ids))
+    return len(upload_ids)
+
+def _purge_loop(stop: threading.Event):
+    while not stop.wait(min(SESSION_TTL, 3600)):
+        try:
+            purge_expired()
+        except Exception:
+            logger.exception("Upload purge failed")
+
+def start() -> threading.Event:
+    stop = threading.Event()
+    if SESSION_TTL > 0:
+        threading.Thread(target=_purge_loop, args=(stop,), name="upload-purge", daemon=True).start()
+    return stop
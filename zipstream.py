@@ -0,0 +1,99 @@
+import json
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+
+from storage import storage
+
+CHUNK_SIZE = 1024 * 1024
+FIXED_DATE = (1980, 1, 1, 0, 0, 0)
+SIZE_WORKERS = 32
+
+class _Sink:
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def _entry_name(index: int, title: str, file: str) -> str:
+    safe_title = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', "_", title or "").strip(" .") or "audio"
+    return f"{index:04d} - {safe_title[:100]}{Path(file).suffix.lower()}"
+
+def _zip_info(name: str, size: int) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=FIXED_DATE)
+    info.compress_type = zipfile.ZIP_STORED
+    info.external_attr = 0o644 << 16
+    info.file_size = size
+    return info
+
+def build_entries(audios: list) -> list:
+    # Размеры нужны до первого байта архива; на S3 это HEAD на файл, поэтому запросы идут параллельно
+    with ThreadPoolExecutor(max_workers=SIZE_WORKERS) as executor:
+        sizes = list(executor.map(storage.size, [audio["file"] for audio in audios]))
+    return [
+        {
+            "name": _entry_name(index, audio["title"], audio["file"]),
+            "key": audio["file"],
+            "size": size,
+            "audio": audio
+        }
+        for index, (audio, size) in enumerate(zip(audios, sizes), start=1)
+    ]
+
+def manifest(entries: list) -> bytes:
+    return json.dumps({
+        "files": [
+            {
+                "path": entry["name"],
+                "size": entry["size"],
+                "missing": entry["size"] is None,
+                "id": entry["audio"]["id"],
+                "title": entry["audio"]["title"],
+                "bpm": entry["audio"]["bpm"],
+                "key": entry["audio"]["key"],
+                "instrument": entry["audio"]["instrument"],
+                "is_loop": entry["audio"]["is_loop"],
+                "genres": entry["audio"]["genres"],
+                "author": entry["audio"]["author"]["username"] if entry["audio"]["author"] else None
+            }
+            for entry in entries
+        ]
+    }, ensure_ascii=False, indent=2, sort_keys=True).encode()
+
+def iter_zip(entries: list):
+    for data in _iter_zip(entries):
+        if data:
+            yield data
+
+def _iter_zip(entries: list):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        data = manifest(entries)
+        archive.writestr(_zip_info("manifest.json", len(data)), data)
+        yield sink.drain()
+
+        for entry in entries:
+            if entry["size"] is None:
+                continue
+            with closing(storage.open(entry["key"])) as source, \
+                    archive.open(_zip_info(entry["name"], entry["size"]), mode="w") as target:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()